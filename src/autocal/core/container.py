@@ -1,10 +1,117 @@
-from .node import CalibrationNode
+from .graph import DependencyGraph
+from ..database.snapshot import save_snapshot
 
 
 class NodeContainer:
-    def __init__(self, dag_container) -> None:
-        pass
+    """Indexed store of the nodes of a DAG, with the closures precomputed at construction:
+    the nodes are numbered in topological order, and the ancestors (upper branch) and descendants
+    (lower branch) of every node are kept as integer bitsets, where bit i stands for node i.
+    Thus "does A depend on B" is a single bit test, and the branches of several nodes are unions of bitsets,
+    read out in topological order by the order of the bits.
+    """
+
+    def __init__(self, dag_container, snapshot_path=None) -> None:
+        """
+        args:
+            dag_container: dictionary of node name -> node, as returned by dict2dag
+            snapshot_path: file the state of all nodes is saved to after every successful pass (see save_snapshot), or None
+        """
+        self.dag_container = dag_container
+        self.snapshot_path = snapshot_path
+        graph = DependencyGraph({name: [d.name for d in node.dependents]
+                                 for name, node in dag_container.items()})
+        order = graph.topological_order()
+        self.names = [graph.names[i] for i in order]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.nodes = [dag_container[name] for name in self.names]
+        position = {graph_id: i for i, graph_id in enumerate(order)}
+        dependents = [[position[j] for j in graph.dependents[graph_id]]
+                      for graph_id in order]
+        children = [[position[j] for j in graph.children[graph_id]]
+                    for graph_id in order]
+        # the bit of the node itself is included in both closures
+        self.ancestors = [0] * len(self.nodes)
+        for i in range(len(self.nodes)):
+            mask = 1 << i
+            for j in dependents[i]:
+                mask |= self.ancestors[j]
+            self.ancestors[i] = mask
+        self.descendants = [0] * len(self.nodes)
+        for i in reversed(range(len(self.nodes))):
+            mask = 1 << i
+            for j in children[i]:
+                mask |= self.descendants[j]
+            self.descendants[i] = mask
+        # the nodes no other node depends on, i.e. the final targets of the DAG
+        self.leaf_nodes = [self.nodes[i]
+                           for i in range(len(self.nodes)) if not children[i]]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_name):
+        return node_name in self.index
 
     def get_node(self, node_name):
+        """return the node of a name, raise KeyError if there is no such node"""
+        try:
+            return self.nodes[self.index[node_name]]
+        except KeyError:
+            raise KeyError(f"{node_name} is not a node of the DAG")
 
     def get_leaf_nodes(self):
+        """return the nodes no other node depends on"""
+        return list(self.leaf_nodes)
+
+    def _mask(self, closures, node_names):
+        mask = 0
+        for node_name in node_names:
+            if node_name not in self.index:
+                raise KeyError(f"{node_name} is not a node of the DAG")
+            mask |= closures[self.index[node_name]]
+        return mask
+
+    def _read(self, mask):
+        """the nodes of a bitset, in topological order"""
+        nodes = list()
+        while mask:
+            low = mask & -mask
+            nodes.append(self.nodes[low.bit_length() - 1])
+            mask ^= low
+        return nodes
+
+    def depends_on(self, node_name, other_name):
+        """return True if the node depends, directly or not, on the other node"""
+        return node_name != other_name and \
+            bool(self._mask(self.ancestors, [node_name]) >> self.index[other_name] & 1)
+
+    def upper_branch(self, *node_names):
+        """return the given nodes and all nodes they depend on, in topological order"""
+        return self._read(self._mask(self.ancestors, node_names))
+
+    def lower_branch(self, *node_names):
+        """return the given nodes and all nodes depending on them, in topological order"""
+        return self._read(self._mask(self.descendants, node_names))
+
+    def invalidated_by(self, node_name):
+        """return the nodes to be checked again if the node is recalibrated, in topological order"""
+        return self._read(self._mask(self.descendants, [node_name]) & ~(1 << self.index[node_name]))
+
+    def maintain(self, *node_names):
+        """maintain the given nodes (all leaf nodes if none is given) and their upper branches,
+        each node once, in topological order.
+        if maintenance could not be finished, a MaintainFailure will be raised.
+        """
+        if not node_names:
+            node_names = [node.name for node in self.leaf_nodes]
+        nodes = self.upper_branch(*node_names)
+        for node in nodes:
+            node.clear_flags()
+        try:
+            for node in nodes:
+                node._maintain_node()
+        finally:
+            for node in nodes:
+                node.clear_flags()
+        if self.snapshot_path is not None:
+            save_snapshot(self.snapshot_path, self.dag_container)
@@ -0,0 +1,117 @@
+from collections import deque
+from .exceptions import ParsingFailure
+
+
+class DependencyGraph:
+    """Adjacency arrays of a DAG, with the nodes indexed by integer ids.
+    All traversals are iterative, so the size of the graph is not limited by the recursion limit.
+    Attributes:
+        names: list of node names, indexed by node id
+        index: dictionary of node name -> node id
+        dependents: list of lists, the ids of the nodes which node i depends on
+        children: list of lists, the ids of the nodes depending on node i
+    """
+
+    def __init__(self, dag_dict) -> None:
+        """
+        args:
+            dag_dict: dictionary of node name -> iterable of the names of its dependents
+        """
+        self.names = list(dag_dict.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.dependents = list()
+        for name in self.names:
+            ids = list()
+            for n in dag_dict[name]:
+                if n not in self.index:
+                    raise ParsingFailure(
+                        f"node {name} has a unresolved parents {n}")
+                ids.append(self.index[n])
+            self.dependents.append(ids)
+        self.children = [list() for _ in self.names]
+        for i, ids in enumerate(self.dependents):
+            for j in ids:
+                self.children[j].append(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def topological_order(self):
+        """Kahn's algorithm, return the node ids with every node placed after all its dependents"""
+        waiting = [len(ids) for ids in self.dependents]
+        ready = deque(i for i, w in enumerate(waiting) if w == 0)
+        order = list()
+        while ready:
+            i = ready.popleft()
+            order.append(i)
+            for c in self.children[i]:
+                waiting[c] -= 1
+                if waiting[c] == 0:
+                    ready.append(c)
+        if len(order) < len(self.names):
+            loop = "-".join(self.names[i] for i in self.find_cycle())
+            raise ParsingFailure(
+                f"the graph is not acyclic, with a loop {loop}")
+        return order
+
+    def find_cycle(self):
+        """return the node ids along a loop, with the first node repeated in the end
+        or an empty list if the graph is acyclic
+        """
+        # 0: not visited, 1: on the current path, 2: finished
+        color = [0] * len(self.names)
+        for root in range(len(self.names)):
+            if color[root]:
+                continue
+            color[root] = 1
+            stack = [(root, iter(self.dependents[root]))]
+            while stack:
+                node, pending = stack[-1]
+                for n in pending:
+                    if color[n] == 1:
+                        path = [i for i, _ in stack]
+                        return path[path.index(n):] + [n]
+                    if color[n] == 0:
+                        color[n] = 1
+                        stack.append((n, iter(self.dependents[n])))
+                        break
+                else:
+                    color[node] = 2
+                    stack.pop()
+        return list()
+
+    def upper_branch(self, ids):
+        """return the set of the given node ids and all the ids they depend on"""
+        selected = set(ids)
+        stack = list(selected)
+        while stack:
+            for j in self.dependents[stack.pop()]:
+                if j not in selected:
+                    selected.add(j)
+                    stack.append(j)
+        return selected
+
+
+def post_order(roots, successors):
+    """iterative depth first traversal over objects of a DAG,
+    every reachable object is yielded once, after all of its successors
+    args:
+        roots: iterable of the starting objects
+        successors: function returning the successors of an object
+    """
+    visited = set()
+    for root in roots:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(successors(root)))]
+        while stack:
+            node, pending = stack[-1]
+            for n in pending:
+                if n not in visited:
+                    visited.add(n)
+                    stack.append((n, iter(successors(n))))
+                    break
+            else:
+                stack.pop()
+                yield node
@@ -13,15 +13,15 @@ class ParamsType(Enum):
 
 class MiniLogger:
     def __init__(self) -> None:
-        self.log = ""
+        self.text = ""
 
     def log(self, info):
-        self.log = self.log + self.formatting(info)
+        self.text = self.text + self.formatting(info)
 
     def dump(self):
-        log = self.log
-        self.log = ""
-        return log
+        text = self.text
+        self.text = ""
+        return text
 
     @staticmethod
     def formatting(text):
@@ -50,7 +50,7 @@ def bad_data_result():
 
 
 def succeeded_result(calibrated_params):
-    return CalibrationResult(bad_data=True,
+    return CalibrationResult(bad_data=False,
                              succeeded=True,
                              error_message="",
                              calibrated_params=calibrated_params)
@@ -85,6 +85,14 @@ class Calibration:
         self.dependent_param_keys = dependent_param_keys
         self.dependent_params = np.zeros(len(dependent_param_keys))
         self.timeout = timeout
+        # the raw data (x_data, y_data) behind the next record, kept by the node if it has a ScanStore
+        self.last_scan = None
+
+    def pop_scan(self):
+        """return and forget the raw data of the last scan, None if there is none"""
+        scan = self.last_scan
+        self.last_scan = None
+        return scan
 
     def check_data(self, param):
         """To implement the check data behavior: if the acquired data
@@ -107,10 +115,25 @@ class Calibration:
                 calibrated_params: dict
         """
         self.logger.log("calibrate method is not inherited and thus not valid")
-        calibrated_params = np.zeros[len(self.param_keys)]
+        calibrated_params = np.zeros(len(self.param_keys))
         return CalibrationResult(False, False, "default", calibrated_params)
 
 
+class AsyncCalibration(Calibration):
+    """The asynchronous variant of Calibration, check_data and calibrate are coroutines,
+    so that a single event loop could wait for several instruments at the same time.
+    The synchronous Calibration subclasses are still accepted by the nodes, run in an executor.
+    """
+
+    async def check_data(self, param):
+        """see Calibration.check_data"""
+        return Calibration.check_data(self, param)
+
+    async def calibrate(self):
+        """see Calibration.calibrate"""
+        return Calibration.calibrate(self)
+
+
 class PhysicalCalibration(Calibration):
     """implement helper functions for basic data analysis
     One implement one model for regression/prediction: y = f(x, theta), 
@@ -158,6 +181,7 @@ class PhysicalCalibration(Calibration):
         return:
             result: True if the data pass, or False if the data fails
         """
+        self.last_scan = (x_data, y_data)
         if self.bad_data(x_data, y_data):
             return CheckDataResult(bad_data=True,
                                    in_spec=False)  # bad data
@@ -171,6 +195,7 @@ class PhysicalCalibration(Calibration):
                                    in_spec=False)
 
     def fit(self, x_data, y_data, p0=None):
+        self.last_scan = (x_data, y_data)
         if self.bad_data(x_data, y_data):
             return bad_data_result()
         with warnings.catch_warnings():
@@ -199,3 +224,16 @@ class PhysicalCalibration(Calibration):
     @staticmethod
     def max_relative_error(data1, data2):
         return np.max(np.abs(data1-data2))
+
+
+class AsyncPhysicalCalibration(PhysicalCalibration):
+    """The asynchronous variant of PhysicalCalibration, the data acquisition (scan) is awaitable,
+    while the data processing (fit, test_in_spec) stays synchronous
+    """
+
+    async def scan(self, sweep_space, downsampling=1):
+        """see PhysicalCalibration.scan"""
+        return (sweep_space, sweep_space)
+
+    check_data = AsyncCalibration.check_data
+    calibrate = AsyncCalibration.calibrate
@@ -1,6 +1,11 @@
 from enum import Enum
 from datetime import datetime, timedelta
+import asyncio
+import functools
+import threading
 from .exceptions import DiagnoseFailure, MaintainFailure, CalibrationFailure
+from .graph import post_order
+from ..database import snapshot
 
 
 class CheckDataResult(Enum):
@@ -20,6 +25,48 @@ class Node:
         """
         self.name = name
         self.dependents = dependents
+        # the reversed edges, the nodes depending on this one
+        self.children = list()
+        for node in dependents:
+            node.children.append(self)
+        self.discovered = False
+
+    def relink(self, dependents):
+        """replace the dependent nodes, e.g. by the nodes rebuilt after a configuration change"""
+        for node in self.dependents:
+            node.children.remove(self)
+        self.dependents = dependents
+        for node in dependents:
+            node.children.append(self)
+
+    def upper_branch(self):
+        """return this node and all upper branch nodes, every node placed after its dependents"""
+        return list(post_order([self], lambda n: n.dependents))
+
+    def connected_nodes(self):
+        """return the dictionary of node name -> node of the whole DAG this node belongs to"""
+        nodes = {self.name: self}
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for neighbour in node.dependents + node.children:
+                if neighbour.name not in nodes:
+                    nodes[neighbour.name] = neighbour
+                    stack.append(neighbour)
+        return nodes
+
+    def save_snapshot(self, path):
+        """write the snapshot of all nodes of the DAG, see database.save_snapshot"""
+        snapshot.save_snapshot(path, self.connected_nodes())
+
+    def reset_flags(self):
+        """reset all upper branch recalibrated flag to false"""
+        for node in self.upper_branch():
+            node.clear_flags()
+
+    def clear_flags(self):
+        """reset the traversing flags of this node only"""
+        self.discovered = False
 
 
 class CalibrationNode(Node):
@@ -34,18 +81,20 @@ class CalibrationNode(Node):
     4) timestamps, used for determining if a calibration is needed
     """
 
-    def __init__(self, calibration, database, dependents):
+    def __init__(self, calibration, database, dependents, scan_store=None):
         """ initialize a calibration node,
         args:
             calibration: the physical 
-            database: a CalibrationDatabase object
+            database: a CalibrationStorage object (see autocal.database.storage)
             dependents: list of CalibrationNode, the dependent calibrations
+            scan_store: a ScanStore object keeping the raw data of the records, or None
         """
         super().__init__(calibration.name, dependents)
-        # name with timestamp, corresponds to the database table name
-        self.table_name = f"{calibration.name}_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
+        # corresponds to the node in the database, whose records are kept across runs
+        self.table_name = calibration.name
         self.calibration = calibration
         self.database = database
+        self.scan_store = scan_store
         self.database.initialize_table(
             self.table_name, self.calibration.param_keys)
         self.period_of_validity = timedelta(minutes=calibration.timeout)
@@ -53,18 +102,35 @@ class CalibrationNode(Node):
         # flags for DFS traversing
         self.calibration_failed = False
         self.discovered = False
+        # memorized result of check_state in this run, None if not yet evaluated
+        self.state = None
+        # functions called with this node after every update of its parameters
+        self.update_callbacks = list()
+        # guards diagnose/calibrate when independent branches are maintained concurrently
+        self.lock = threading.RLock()
 
     def check_data(self):
         """check if a calibration needs to be done, by taking limited data"""
+        last_params = self._prepare_check_data()
+        if last_params is None:
+            return CheckDataResult.OUT_OF_SPEC  # never calibrated, nothing to check against
+        return self._evaluate_check_data(self.calibration.check_data(last_params), last_params)
+
+    def _prepare_check_data(self):
+        """retrieve the parameters to be checked, None if the node has never been calibrated"""
+        if self.database.last_timestamp(self.table_name) is None:
+            return None
         self.retrieve_dependent_params()
-        last_params = self.database.last_params(
+        return self.database.last_params(
             self.table_name, *self.calibration.param_keys)
-        result = self.calibration.check_data(last_params)
+
+    def _evaluate_check_data(self, result, last_params):
         if result.bad_data:
             return CheckDataResult.BAD_DATA
         if result.in_spec:
             # if check_data is passed, also generated a database record to refresh the timestamp
-            self.update_params(last_params)
+            self.update_params(
+                dict(zip(self.calibration.param_keys, last_params)))
             return CheckDataResult.IN_SPEC
         else:
             return CheckDataResult.OUT_OF_SPEC
@@ -74,19 +140,49 @@ class CalibrationNode(Node):
         Based on prior knowledge (without data), determine if a calibration needs to be done
         True <-> passed check, not necessary to calibrate
         False <-> failed check, need to calibrate
+        The state is evaluated once per run, until the node is updated or reset_flags is called;
+        every maintenance pass starts with the states forgotten
         """
+        if self.state is None:
+            # evaluate the unknown upper branch states first, parents before children
+            for node in post_order([self], lambda n: [p for p in n.dependents if p.state is None]):
+                node.state = node._check_state()
+        return self.state
+
+    def _check_state(self):
         if self.timeout or self.calibration_failed:
             return False  # fail if timed out or just failed an calibration
-        if not all([p.check_state() for p in self.parents]):
+        if not all([p.state for p in self.dependents]):
             return False  # fail if one of the parents failed
-        if any([p.recalibrated for p in self.parents]):
+        if any([p.recalibrated for p in self.dependents]):
             return False  # fail if one parent has been recalibrated in this run
         return True
 
     def update_params(self, param_dict):
-        self.database.insert(table_name=self.table_name,
-                             var_dict=param_dict,
-                             calibration_log=self.calibration.logger.dump())
+        timestamp = self.database.insert(table_name=self.table_name,
+                                         var_dict=param_dict,
+                                         calibration_log=self.calibration.logger.dump())
+        scan = self.calibration.pop_scan()
+        if self.scan_store is not None and scan is not None:
+            self.scan_store.save(self.table_name, timestamp, *scan)
+        self.invalidate_state()
+        for callback in self.update_callbacks:
+            callback(self)
+
+    def relink(self, dependents):
+        super().relink(dependents)
+        # the state depends on the states of the new dependents
+        self.invalidate_state()
+
+    def invalidate_state(self):
+        """forget the memorized state of this node and all lower branch nodes"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            # a memorized state implies memorized states of all parents, so unset branches are skipped
+            if node.state is not None:
+                node.state = None
+                stack.extend(node.children)
 
     @staticmethod
     def parse_param_key(key):
@@ -97,26 +193,32 @@ class CalibrationNode(Node):
         return [s.strip() for s in raw]
 
     def retrieve_dependent_params(self):
-        retrieved_dependent_params = list()
+        tables = {p.name: p.table_name for p in self.dependents}
+        keys = list()
         for key in self.calibration.dependent_param_keys:
             node_name, param_key = self.parse_param_key(key)  # parse
-            table_name = None
-            for p in self.dependents:
-                if p.name == node_name:
-                    table_name = p.table_name
-            if table_name:
-                retrieved_dependent_params.append(
-                    *self.database.last_params(table_name, param_key))
-            else:
+            if node_name not in tables:
                 raise CalibrationFailure(
                     f"{node_name} not resolved in parents")
-        # update
-        self.calibration.dependent_params = retrieved_dependent_params
+            keys.append((tables[node_name], param_key))
+        # update, all parameters are retrieved in one query
+        self.calibration.dependent_params = self.database.last_params_many(
+            keys)
+
+    @property
+    def expiry(self):
+        """return the datetime when the calibration times out, or None if never calibrated"""
+        last_calibrated_time = self.database.last_timestamp(self.table_name)
+        if last_calibrated_time is None:
+            return None
+        return last_calibrated_time + self.period_of_validity
 
     @property
     def timeout(self):
         """return True if the calibration has timed out and need to be redone"""
         last_calibrated_time = self.database.last_timestamp(self.table_name)
+        if last_calibrated_time is None:
+            return True  # never calibrated
         if datetime.now() - last_calibrated_time > self.period_of_validity:
             return True
         else:
@@ -127,27 +229,63 @@ class CalibrationNode(Node):
         return:
             recalibrated: true if the diagnostic is done with a recalibration
         """
-        check_data_result = self.check_data()
-        # if already in spec, return without any calibration
-        if check_data_result == CheckDataResult.IN_SPEC:
-            return False
-        # if bad data, check whether dependents needs recalibration:
-        # if none needs to do so, return a failure (the reason for acquiring bad data is not found)
-        elif check_data_result == CheckDataResult.BAD_DATA:
-            recalibrated = [n.diagnose() for n in self.dependents]
-        if not any(recalibrated):
-            raise DiagnoseFailure(self.calibration.name)
-        # if out of spec / dependents already been recalibrated, just do a calibration on this node and update parameters
-        self.update_params(self.calibrate())
-        self.recalibrated = True
-        return True
+        # explicit stack of frames [node, iterator over dependents to descend into, check_data result, any dependent recalibrated]
+        # only the nodes of the current path are locked, a frame releases its lock when popped,
+        # so that the locks are always taken from the children to the parents
+        stack = [self._enter_diagnose()]
+        try:
+            while True:
+                frame = stack[-1]
+                dependent = next(frame[1], None)
+                if dependent is not None:
+                    stack.append(dependent._enter_diagnose())
+                    continue
+                stack.pop()
+                recalibrated = frame[0]._exit_diagnose(frame[2], frame[3])
+                if not stack:
+                    return recalibrated
+                stack[-1][3] = stack[-1][3] or recalibrated
+        finally:
+            for frame in reversed(stack):
+                frame[0]._release_diagnose()
 
-    def reset_flags(self):
-        """reset all upper branch recalibrated flag to false"""
-        for node in self.dependents:
-            node.reset_flags()
+    def _enter_diagnose(self):
+        self.lock.acquire()
+        try:
+            check_data_result = self.check_data()
+        except BaseException:
+            self.lock.release()
+            raise
+        # if bad data, check whether dependents needs recalibration
+        if check_data_result == CheckDataResult.BAD_DATA:
+            return [self, iter(self.dependents), check_data_result, False]
+        return [self, iter(()), check_data_result, False]
+
+    def _exit_diagnose(self, check_data_result, dependents_recalibrated):
+        try:
+            # if already in spec, return without any calibration
+            if check_data_result == CheckDataResult.IN_SPEC:
+                return False
+            # if bad data and none of the dependents needs recalibration,
+            # return a failure (the reason for acquiring bad data is not found)
+            if check_data_result == CheckDataResult.BAD_DATA and not dependents_recalibrated:
+                raise DiagnoseFailure(self.calibration.name)
+            # if out of spec / dependents already been recalibrated, just do a calibration on this node and update parameters
+            self.update_params(self.calibrate())
+            self.recalibrated = True
+            return True
+        finally:
+            self._release_diagnose()
+
+    def _release_diagnose(self):
+        """release the lock taken by _enter_diagnose"""
+        self.lock.release()
+
+    def clear_flags(self):
+        """reset the traversing flags of this node only"""
+        super().clear_flags()
         self.recalibrated = False
-        self.discovered = False
+        self.state = None
 
     # exposed interfaces
 
@@ -156,11 +294,19 @@ class CalibrationNode(Node):
         args:
             reset: whether to reset calibrated flag in the end
         """
-        if not self.discovered:
-            self.discovered = True
-            # recursive maintain dependent nodes
-            for n in self.dependents:
-                n._maintain()
+        try:
+            # the upper branch is traversed in topological order, dependent nodes first
+            for node in self.upper_branch():
+                if not node.discovered:
+                    node.discovered = True
+                    node._maintain_node()
+        finally:
+            if reset:
+                self.reset_flags()
+
+    def _maintain_node(self):
+        """maintain this node only, assuming all its dependents have already been maintained"""
+        with self.lock:
             # check_state
             if self.check_state():
                 return
@@ -169,15 +315,41 @@ class CalibrationNode(Node):
                 self.diagnose()
             except DiagnoseFailure as e:
                 # fails if the diagnose of the node fails
-                raise MaintainFailure(self, e.node_failed)
-        if reset:
-            self.reset_flags()
+                raise MaintainFailure(e.node_failed)
 
-    def maintain(self):
-        """maintain the single node all upper branch nodes by DFS recursion
+    def maintain(self, snapshot_path=None):
+        """maintain the single node all upper branch nodes by DFS
         if maintenance could not be finished, a MaintainFailure will be raised.
+        args:
+            snapshot_path: file the state of all nodes is saved to after a successful pass, or None
         """
+        # the states memorized outside of a pass, e.g. by a direct check_state, could be outdated
+        self.reset_flags()
         self._maintain(reset=True)
+        if snapshot_path is not None:
+            self.save_snapshot(snapshot_path)
+
+    def refresh(self, snapshot_path=None):
+        """maintain the upper branch nodes, then check this node with data even if it has not timed out yet,
+        and recalibrate it if necessary. Used to renew a calibration before its validity expires.
+        if the refresh could not be finished, a MaintainFailure will be raised.
+        args:
+            snapshot_path: see maintain
+        """
+        self.reset_flags()
+        try:
+            for node in self.upper_branch()[:-1]:
+                if not node.discovered:
+                    node.discovered = True
+                    node._maintain_node()
+            try:
+                self.diagnose()
+            except DiagnoseFailure as e:
+                raise MaintainFailure(e.node_failed)
+        finally:
+            self.reset_flags()
+        if snapshot_path is not None:
+            self.save_snapshot(snapshot_path)
 
     def calibrate(self):
         """
@@ -187,10 +359,13 @@ class CalibrationNode(Node):
             dictionary contains the mapping: parameter name -> parameter value
         """
         self.retrieve_dependent_params()
-        result = self.calibration.calibrate()
+        return self._evaluate_calibration(self.calibration.calibrate())
+
+    def _evaluate_calibration(self, result):
         # if bad data acquired in the measurement
         if result.bad_data:
             self.calibration_failed = True
+            self.invalidate_state()
             raise CalibrationFailure(
                 "Bad data in a real calibration, manual inspection is required")
         # if the data is okay
@@ -198,22 +373,136 @@ class CalibrationNode(Node):
             return dict(zip(self.calibration.param_keys, result.calibrated_params))
         else:
             self.calibration_failed = True
+            self.invalidate_state()
             raise CalibrationFailure(
                 f"Data analysis failed with error code [{result.error_message}]")
 
+    # asynchronous interfaces, blocking calibrations are run in the default executor
+
+    async def _await_calibration(self, method, *args):
+        """await a method of the calibration, which could either be a coroutine or a blocking function"""
+        if asyncio.iscoroutinefunction(method):
+            return await method(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(method, *args))
+
+    async def check_data_async(self):
+        """asynchronous variant of check_data"""
+        last_params = self._prepare_check_data()
+        if last_params is None:
+            return CheckDataResult.OUT_OF_SPEC
+        result = await self._await_calibration(self.calibration.check_data, last_params)
+        return self._evaluate_check_data(result, last_params)
+
+    async def calibrate_async(self):
+        """asynchronous variant of calibrate"""
+        self.retrieve_dependent_params()
+        result = await self._await_calibration(self.calibration.calibrate)
+        return self._evaluate_calibration(result)
+
+    async def diagnose_async(self, diagnosing=None):
+        """asynchronous variant of diagnose
+        args:
+            diagnosing: dictionary of node name -> running diagnose, so that a node shared by
+                several branches is only diagnosed once
+        """
+        diagnosing = dict() if diagnosing is None else diagnosing
+        if self.name not in diagnosing:
+            diagnosing[self.name] = asyncio.ensure_future(
+                self._diagnose_async(diagnosing))
+        return await diagnosing[self.name]
+
+    async def _diagnose_async(self, diagnosing):
+        check_data_result = await self.check_data_async()
+        if check_data_result == CheckDataResult.IN_SPEC:
+            return False
+        elif check_data_result == CheckDataResult.BAD_DATA:
+            recalibrated = await asyncio.gather(*[n.diagnose_async(diagnosing) for n in self.dependents])
+            if not any(recalibrated):
+                raise DiagnoseFailure(self.calibration.name)
+        self.update_params(await self.calibrate_async())
+        self.recalibrated = True
+        return True
+
+    async def _maintain_async(self, maintaining, diagnosing):
+        """
+        args:
+            maintaining: dictionary of node name -> maintenance task, every node is maintained once
+            diagnosing: see diagnose_async
+        """
+        for n in self.dependents:
+            if n.name not in maintaining:
+                maintaining[n.name] = asyncio.ensure_future(
+                    n._maintain_async(maintaining, diagnosing))
+        # independent upper branches are maintained concurrently
+        await asyncio.gather(*[maintaining[n.name] for n in self.dependents])
+        if self.check_state():
+            return
+        try:
+            await self.diagnose_async(diagnosing)
+        except DiagnoseFailure as e:
+            raise MaintainFailure(e.node_failed)
+
+    async def maintain_async(self, snapshot_path=None):
+        """asynchronous variant of maintain, the waiting time of independent upper branches overlaps
+        if maintenance could not be finished, a MaintainFailure will be raised.
+        args:
+            snapshot_path: see maintain
+        """
+        self.reset_flags()
+        maintaining = dict()
+        try:
+            await self._maintain_async(maintaining, dict())
+        finally:
+            pending = [t for t in maintaining.values() if not t.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self.reset_flags()
+        if snapshot_path is not None:
+            self.save_snapshot(snapshot_path)
+
 
 class BaseNode(Node):
     def __init__(self, database, **kwargs):
         super().__init__(name="Base", dependents=[])
-        self.table_name = f"Base_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}"
-        # write up all parameters in the database
+        # the base parameters are given, thus never recalibrated and always valid
+        self.recalibrated = False
+        self.state = True
+        self.table_name = "Base"
+        self.database = database
+        # write up all parameters in the database, if changed since the last run
+        # (the parameters removed from the configuration are still in the last record, with None)
         database.initialize_table(self.table_name, kwargs.keys())
-        database.insert(table_name=self.table_name,
-                        var_dict=kwargs,
-                        calibration_log="Base parameters insertion")
+        last = database.last_record(self.table_name)
+        if last is None or {k: last.get(k) for k in kwargs} != kwargs:
+            database.insert(table_name=self.table_name,
+                            var_dict=kwargs,
+                            calibration_log="Base parameters insertion")
 
     def _maintain(self, reset=False):
         pass
 
+    def _maintain_node(self):
+        pass
+
+    def check_state(self):
+        return True
+
     def diagnose(self):
         return False
+
+    def _enter_diagnose(self):
+        return [self, iter(()), CheckDataResult.IN_SPEC, False]
+
+    def _exit_diagnose(self, check_data_result, dependents_recalibrated):
+        return False
+
+    def _release_diagnose(self):
+        pass
+
+    async def _maintain_async(self, maintaining, diagnosing):
+        pass
+
+    async def diagnose_async(self, diagnosing=None):
+        return False
@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+import heapq
+import threading
+from .graph import DependencyGraph
+from .node import CalibrationNode
+from ..database.snapshot import save_snapshot
+
+
+class ParallelMaintainer:
+    """To maintain a DAG of calibration nodes with independent branches running concurrently.
+    A node is handed to the thread pool as soon as all its dependents are maintained,
+    thus a maintenance pass takes the time of the critical path instead of the sum of all nodes.
+    The semantics of CalibrationNode.maintain are kept: the recalibrated flags propagate to
+    the later nodes, and the first MaintainFailure stops the scheduling of new nodes.
+    """
+
+    def __init__(self, dag_container, max_workers=None, snapshot_path=None) -> None:
+        """
+        args:
+            dag_container: dictionary of node name -> node, as returned by dict2dag
+            max_workers: maximal number of nodes maintained at the same time
+            snapshot_path: file the state of all nodes is saved to after every successful pass (see save_snapshot), or None
+        """
+        self.dag_container = dag_container
+        self.max_workers = max_workers
+        self.snapshot_path = snapshot_path
+        self.graph = DependencyGraph({name: [d.name for d in node.dependents]
+                                      for name, node in dag_container.items()})
+        self.sorted = self.graph.topological_order()
+
+    def upper_branches(self, targets):
+        """return the names of the targets and all their upper branch nodes, in topological order"""
+        return [self.graph.names[i] for i in self._upper_branch_ids(targets)]
+
+    def _upper_branch_ids(self, targets):
+        if not targets:
+            return list(self.sorted)
+        selected = self.graph.upper_branch(
+            self.graph.index[name] for name in targets)
+        return [i for i in self.sorted if i in selected]
+
+    def maintain(self, *targets):
+        """maintain the target nodes and all upper branch nodes (the whole DAG if no target is given)
+        if maintenance could not be finished, a MaintainFailure will be raised.
+        """
+        ids = self._upper_branch_ids(targets)
+        selected = set(ids)
+        nodes = [self.dag_container[name] for name in self.graph.names]
+        for i in ids:
+            nodes[i].clear_flags()
+        # number of dependents not yet maintained
+        waiting = {i: len(self.graph.dependents[i]) for i in ids}
+        failure = None
+        try:
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                running = dict()
+
+                def submit(i):
+                    running[executor.submit(nodes[i]._maintain_node)] = i
+
+                for i in ids:
+                    if waiting[i] == 0:
+                        submit(i)
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = running.pop(future)
+                        if future.exception() is not None:
+                            failure = failure or future.exception()
+                        if failure is not None:
+                            continue  # drain the running nodes without scheduling new ones
+                        for child in self.graph.children[i]:
+                            if child in selected:
+                                waiting[child] -= 1
+                                if waiting[child] == 0:
+                                    submit(child)
+        finally:
+            for i in ids:
+                nodes[i].clear_flags()
+        if failure is not None:
+            raise failure
+        # after a failed pass, the snapshot on disk is outdated and discarded on restore by its marker
+        if self.snapshot_path is not None:
+            save_snapshot(self.snapshot_path, self.dag_container)
+
+
+class ExpiryScheduler:
+    """To refresh the calibration nodes before their period of validity expires.
+    A heap of (expiry time, node name) is kept by a daemon thread, which sleeps until the earliest
+    deadline and then refreshes the node with its upper branch. The heap is updated on every update
+    of a node, thus the database is only queried for the timestamps once at the start.
+    Maintenance invoked by the user concurrently should hold the lock of the scheduler.
+    """
+
+    def __init__(self, dag_container, margin=timedelta(minutes=1), retry=timedelta(minutes=1),
+                 snapshot_path=None) -> None:
+        """
+        args:
+            dag_container: dictionary of node name -> node, as returned by dict2dag
+            margin: timedelta, how long before the expiry the node is refreshed, at most half of the
+                period of validity of the node, so that a refresh is not due again right after it
+            retry: timedelta, delay before another attempt if a refresh failed
+            snapshot_path: file the state of all nodes is saved to after every successful refresh (see save_snapshot), or None
+        """
+        self.dag_container = dag_container
+        self.snapshot_path = snapshot_path
+        self.nodes = {name: node for name, node in dag_container.items()
+                      if isinstance(node, CalibrationNode)}
+        self.margin = margin
+        self.retry = retry
+        self.lock = threading.RLock()
+        self.condition = threading.Condition()
+        self.heap = list()
+        # the latest deadline of every node, outdated heap entries are discarded lazily
+        self.deadlines = dict()
+        # list of (node name, exception) of the failed refreshes
+        self.failures = list()
+        self.running = False
+        self.thread = None
+
+    def schedule(self, name, deadline):
+        """(re)schedule the refresh of a node before the deadline"""
+        with self.condition:
+            self.deadlines[name] = deadline
+            heapq.heappush(self.heap, (deadline, name))
+            self.condition.notify()
+
+    def node_margin(self, name):
+        """return how long before its expiry a node is refreshed"""
+        return min(self.margin, self.nodes[name].period_of_validity / 2)
+
+    def _on_update(self, node):
+        self.schedule(node.name, datetime.now() + node.period_of_validity)
+
+    def start(self):
+        """read the expiry of all nodes and start the daemon thread"""
+        now = datetime.now()
+        for name, node in self.nodes.items():
+            expiry = node.expiry
+            self.schedule(name, now if expiry is None else expiry)
+            node.update_callbacks.append(self._on_update)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """stop the daemon thread, after the running refresh is finished"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for node in self.nodes.values():
+            if self._on_update in node.update_callbacks:
+                node.update_callbacks.remove(self._on_update)
+
+    def _next_due(self):
+        """block until a node is due, return its name, or None if the scheduler is stopped"""
+        with self.condition:
+            while self.running:
+                if self.heap and self.deadlines[self.heap[0][1]] != self.heap[0][0]:
+                    heapq.heappop(self.heap)  # outdated entry
+                    continue
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, name = self.heap[0]
+                delay = (deadline - self.node_margin(name) -
+                         datetime.now()).total_seconds()
+                if delay <= 0:
+                    return heapq.heappop(self.heap)[1]
+                self.condition.wait(delay)
+            return None
+
+    def _run(self):
+        while True:
+            name = self._next_due()
+            if name is None:
+                return
+            try:
+                with self.lock:
+                    self.nodes[name].refresh()
+                    if self.snapshot_path is not None:
+                        save_snapshot(self.snapshot_path, self.dag_container)
+            except Exception as e:
+                self.failures.append((name, e))
+                self.schedule(name, datetime.now() + self.node_margin(name) + self.retry)
@@ -1 +1,10 @@
+from .storage import CalibrationStorage, validate_name
 from .database import CalibrationDatabase
+from .memory import InMemoryDatabase
+from .columnar import ColumnarDatabase
+from .cache import LatestRecordCache
+from .write_behind import WriteBehindDatabase
+from .scans import ScanStore
+from .buckets import HistoryBuckets
+from .snapshot import Snapshot, save_snapshot, write_snapshot, read_snapshot
+from .compaction import Compactor
@@ -0,0 +1,44 @@
+import typing
+from datetime import timedelta
+import numpy as np
+
+
+class HistoryBuckets(typing.NamedTuple):
+    """the history of a parameter aggregated over time buckets, one entry per non-empty bucket
+    all fields are NumPy arrays, the timestamps being integer nanoseconds since the epoch
+    """
+    start: np.ndarray  # int64, the start of the bucket
+    count: np.ndarray  # int64, the number of records with the parameter
+    min: np.ndarray
+    max: np.ndarray
+    mean: np.ndarray
+    last: np.ndarray  # the value of the latest record
+
+
+def bucket_width(interval):
+    """return the width of the buckets in integer nanoseconds, from a timedelta"""
+    width = interval // timedelta(microseconds=1) * 1000
+    if width <= 0:
+        raise ValueError("the interval of the buckets has to be positive")
+    return width
+
+
+def bucket_arrays(timestamps, values, width, origin):
+    """aggregate the values (NaN if missing) at sorted integer nanosecond timestamps into buckets"""
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    timestamps, values = np.asarray(timestamps)[present], values[present]
+    if len(values) == 0:
+        empty = np.zeros(0)
+        return HistoryBuckets(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                              empty, empty, empty, empty)
+    buckets = (timestamps - origin) // width
+    ends = np.append(np.flatnonzero(np.diff(buckets)) + 1, len(values))
+    starts = np.insert(ends[:-1], 0, 0)
+    count = ends - starts
+    return HistoryBuckets(start=origin + buckets[starts] * width,
+                          count=count.astype(np.int64),
+                          min=np.minimum.reduceat(values, starts),
+                          max=np.maximum.reduceat(values, starts),
+                          mean=np.add.reduceat(values, starts) / count,
+                          last=values[ends - 1])
@@ -0,0 +1,137 @@
+import threading
+from .snapshot import read_snapshot
+
+
+class LatestRecordCache:
+    """Write-through cache of the last record of every table, in front of a CalibrationStorage.
+    The reads of the last parameters and timestamps are served from memory after the first access,
+    the inserts are written to the database and update the cache.
+    It assumes this process is the only writer, otherwise the cache should be invalidated
+    explicitly, or by polling detect_external_writes.
+    """
+
+    def __init__(self, database) -> None:
+        """
+        args:
+            database: the CalibrationStorage to be cached
+        """
+        self.database = database
+        self.lock = threading.RLock()
+        # table name -> (timestamp, dictionary of parameter name -> value) of the last record
+        self.records = dict()
+        self.data_version = self._data_version()
+
+    def __getattr__(self, name):
+        # everything not cached is passed to the database
+        return getattr(self.database, name)
+
+    def initialize_table(self, table_name, var_keys):
+        self.initialize_tables({table_name: var_keys})
+
+    def initialize_tables(self, tables):
+        self.database.initialize_tables(tables)
+        with self.lock:
+            for table_name, var_keys in tables.items():
+                cached = self.records.get(table_name)
+                if cached is not None and cached[1] is not None:
+                    # the new parameters are missing in the last record
+                    self.records[table_name] = (cached[0],
+                                                {**dict.fromkeys(var_keys), **cached[1]})
+
+    def invalidate(self, table_name=None):
+        """drop the cached record of a table, or of all tables if no table is given"""
+        with self.lock:
+            if table_name is None:
+                self.records.clear()
+            else:
+                self.records.pop(table_name, None)
+
+    def restore(self, path):
+        """fill the cache from a snapshot (see save_snapshot) in one read, instead of querying every table
+        the snapshot is only used if the database has not been written since, i.e. if the state marker
+        of the database is unchanged, which the databases without state marker could not tell
+        return:
+            True if restored, False if the snapshot is missing, invalid or outdated, the cache being filled on demand then
+        """
+        if not hasattr(self.database, "state_marker"):
+            return False
+        try:
+            snapshot = read_snapshot(path)
+        except (OSError, ValueError):
+            return False
+        if snapshot.marker != self.database.state_marker():
+            return False
+        with self.lock:
+            for table_name, (timestamp, _, params) in snapshot.records.items():
+                self.records[table_name] = (timestamp, params)
+        return True
+
+    def _data_version(self):
+        # only the SQLite database could detect the writes of other connections
+        if hasattr(self.database, "data_version"):
+            return self.database.data_version()
+        return None
+
+    def detect_external_writes(self):
+        """invalidate the whole cache if another connection has written to the database since the last call
+        return:
+            True if external writes are detected
+        """
+        with self.lock:
+            data_version = self._data_version()
+            if data_version == self.data_version:
+                return False
+            self.data_version = data_version
+            self.invalidate()
+            return True
+
+    def _record(self, table_name):
+        with self.lock:
+            if table_name not in self.records:
+                self.records[table_name] = (self.database.last_timestamp(table_name),
+                                            self.database.last_record(table_name))
+            return self.records[table_name]
+
+    def last_timestamp(self, table_name):
+        return self._record(table_name)[0]
+
+    def last_params(self, table_name, *args):
+        params = self._record(table_name)[1]
+        if params is None:
+            return [None] * len(args)
+        return [params[k] for k in args]
+
+    def last_record(self, table_name):
+        params = self._record(table_name)[1]
+        return None if params is None else dict(params)
+
+    def last_params_many(self, keys):
+        return [self.last_params(table_name, param_key)[0] for table_name, param_key in keys]
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        with self.lock:
+            timestamp = self.database.insert(
+                table_name, var_dict, calibration_log, timestamp=timestamp)
+            self._update(table_name, timestamp, var_dict)
+            return timestamp
+
+    def insert_many(self, records):
+        records = list(records)
+        with self.lock:
+            timestamps = self.database.insert_many(records)
+            for record, timestamp in zip(records, timestamps):
+                self._update(record[0], timestamp, record[1])
+            return timestamps
+
+    def _update(self, table_name, timestamp, var_dict):
+        cached = self.records.get(table_name)
+        if cached is None or cached[1] is None:
+            # the other columns are unknown, thus reloaded on the next read
+            self.records.pop(table_name, None)
+            return
+        if cached[0] is not None and timestamp < cached[0]:
+            return  # a record inserted back in time is not the last one
+        # the columns missing in the new record are NULL
+        params = dict.fromkeys(cached[1])
+        params.update(var_dict)
+        self.records[table_name] = (timestamp, params)
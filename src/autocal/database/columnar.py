@@ -0,0 +1,270 @@
+from pathlib import Path
+import itertools
+import json
+import numbers
+import threading
+import time
+import numpy as np
+from .database import to_ns, from_ns
+from .storage import validate_name
+from .buckets import bucket_width, bucket_arrays
+
+
+class ColumnarDatabase:
+    """Append-only columnar implementation of CalibrationStorage, with one directory per node:
+        meta.json: the parameter names and the kind of their columns
+        timestamp.i8: the timestamps of the records in integer nanoseconds, raw int64
+        {index}.f8: the values of a numeric parameter, raw float64, NaN if missing
+        {index}.json: the values of a non-numeric parameter, one JSON document per line
+        log.json: the calibration logs, one JSON string per line
+    The numeric columns are read through memory mapping, thus analytics over months of drift history
+    neither parse nor copy the whole files. The records of a node have to be inserted in chronological order.
+    """
+
+    def __init__(self, directory) -> None:
+        """
+        args:
+            directory: the root directory of the storage, created if not existing
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        # node name -> {"keys": [...], "kinds": {key: "f8" or "json"}}, number of records, loaded JSON columns
+        self.meta = dict()
+        self.rows = dict()
+        self.json_columns = dict()
+
+    def _node_directory(self, table_name):
+        return self.directory / table_name
+
+    def _column_path(self, table_name, key):
+        meta = self.meta[table_name]
+        return self._node_directory(table_name) / f"{meta['keys'].index(key)}.{meta['kinds'][key]}"
+
+    def _save_meta(self, table_name):
+        path = self._node_directory(table_name) / "meta.json"
+        path.write_text(json.dumps(self.meta[table_name]))
+
+    def _load(self, table_name):
+        if table_name in self.meta:
+            return self.meta[table_name]
+        path = self._node_directory(table_name) / "meta.json"
+        if not path.exists():
+            raise KeyError(
+                f"calibration node {table_name} is not initialized")
+        self.meta[table_name] = json.loads(path.read_text())
+        self.rows[table_name] = (self._node_directory(
+            table_name) / "timestamp.i8").stat().st_size // 8
+        self.json_columns[table_name] = dict()
+        # drop the values of a record interrupted before its timestamp was appended
+        rows = self.rows[table_name]
+        for key, kind in self.meta[table_name]["kinds"].items():
+            path = self._column_path(table_name, key)
+            if kind == "json":
+                with open(path) as f:
+                    values = [json.loads(line) for line in f]
+                if len(values) > rows:
+                    values = values[:rows]
+                    path.write_text(
+                        "".join(json.dumps(v) + "\n" for v in values))
+                self.json_columns[table_name][key] = values
+            elif path.stat().st_size > 8 * rows:
+                with open(path, "r+b") as f:
+                    f.truncate(8 * rows)
+        return self.meta[table_name]
+
+    def initialize_table(self, table_name, var_keys):
+        validate_name(table_name)
+        for k in var_keys:
+            validate_name(k)
+        with self.lock:
+            node_directory = self._node_directory(table_name)
+            if not (node_directory / "meta.json").exists():
+                node_directory.mkdir(exist_ok=True)
+                (node_directory / "timestamp.i8").touch()
+                (node_directory / "log.json").touch()
+                self.meta[table_name] = {"keys": list(), "kinds": dict()}
+                self.rows[table_name] = 0
+                self.json_columns[table_name] = dict()
+            meta = self._load(table_name)
+            for key in var_keys:
+                if key not in meta["keys"]:
+                    meta["keys"].append(key)
+                    meta["kinds"][key] = "f8"
+                    # the existing records miss the new parameter
+                    self._column_path(table_name, key).write_bytes(
+                        np.full(self.rows[table_name], np.nan).tobytes())
+            self._save_meta(table_name)
+
+    def initialize_tables(self, tables):
+        with self.lock:
+            for table_name, var_keys in tables.items():
+                self.initialize_table(table_name, var_keys)
+
+    def _to_json_column(self, table_name, key):
+        """convert a numeric column into a JSON column, when a non-numeric value is to be stored"""
+        path = self._column_path(table_name, key)
+        values = [None if np.isnan(v) else float(v)
+                  for v in np.fromfile(path, dtype="<f8")]
+        self.meta[table_name]["kinds"][key] = "json"
+        self._column_path(table_name, key).write_text(
+            "".join(json.dumps(v) + "\n" for v in values))
+        path.unlink()
+        self.json_columns[table_name][key] = values
+        self._save_meta(table_name)
+
+    def _validate(self, table_name, var_dict, timestamp, last):
+        """validate a record appended after a record at last (integer nanoseconds, None if none)"""
+        meta = self._load(table_name)
+        for k in var_dict:
+            if k not in meta["keys"]:
+                raise KeyError(f"{k} is not a parameter of {table_name}")
+        if last is not None and timestamp < last:
+            raise ValueError(
+                f"records of {table_name} have to be inserted in chronological order")
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        return self.insert_many([(table_name, var_dict, calibration_log, timestamp)])[0]
+
+    def insert_many(self, records):
+        with self.lock:
+            records = [(table_name, var_dict, calibration_log, time.time_ns() if timestamp is None else to_ns(timestamp))
+                       for table_name, var_dict, calibration_log, timestamp in
+                       (tuple(record) + (None,) * (4 - len(record)) for record in records)]
+            # validate all records first, so that a failing record appends nothing,
+            # each one against the previous record of its node, in the batch or stored
+            lasts = dict()
+            for table_name, var_dict, _, timestamp in records:
+                if table_name not in lasts:
+                    self._load(table_name)
+                    lasts[table_name] = self._last_ns(table_name)
+                self._validate(table_name, var_dict, timestamp, lasts[table_name])
+                lasts[table_name] = timestamp
+            return [self._append(*record) for record in records]
+
+    def _append(self, table_name, var_dict, calibration_log, timestamp):
+        meta = self.meta[table_name]
+        node_directory = self._node_directory(table_name)
+        for key in meta["keys"]:
+            value = var_dict.get(key)
+            if meta["kinds"][key] == "f8" and value is not None and not isinstance(value, numbers.Real):
+                self._to_json_column(table_name, key)
+            if meta["kinds"][key] == "f8":
+                with open(self._column_path(table_name, key), "ab") as f:
+                    f.write(np.array([np.nan if value is None else value], dtype="<f8").tobytes())
+            else:
+                with open(self._column_path(table_name, key), "a") as f:
+                    f.write(json.dumps(value) + "\n")
+                self.json_columns[table_name][key].append(value)
+        with open(node_directory / "log.json", "a") as f:
+            f.write(json.dumps(calibration_log) + "\n")
+        # the timestamp is appended last, it marks the record as complete
+        with open(node_directory / "timestamp.i8", "ab") as f:
+            f.write(np.array([timestamp], dtype="<i8").tobytes())
+        self.rows[table_name] += 1
+        return from_ns(timestamp)
+
+    def _read(self, table_name, key, row):
+        """read the value of a parameter in a record"""
+        if self.meta[table_name]["kinds"][key] == "json":
+            return self.json_columns[table_name][key][row]
+        value = np.fromfile(self._column_path(table_name, key),
+                            dtype="<f8", count=1, offset=8 * row)[0]
+        return None if np.isnan(value) else float(value)
+
+    def _last_ns(self, table_name):
+        rows = self.rows[table_name]
+        if rows == 0:
+            return None
+        return int(np.fromfile(self._node_directory(table_name) / "timestamp.i8",
+                               dtype="<i8", count=1, offset=8 * (rows - 1))[0])
+
+    def last_timestamp(self, table_name):
+        with self.lock:
+            self._load(table_name)
+            last = self._last_ns(table_name)
+        return None if last is None else from_ns(last)
+
+    def last_params(self, table_name, *args):
+        with self.lock:
+            meta = self._load(table_name)
+            for k in args:
+                if k not in meta["keys"]:
+                    raise KeyError(f"{k} is not a parameter of {table_name}")
+            rows = self.rows[table_name]
+            if rows == 0:
+                return [None] * len(args)
+            return [self._read(table_name, k, rows - 1) for k in args]
+
+    def last_record(self, table_name):
+        with self.lock:
+            meta = self._load(table_name)
+            if self.rows[table_name] == 0:
+                return None
+            return dict(zip(meta["keys"], self.last_params(table_name, *meta["keys"])))
+
+    def last_params_many(self, keys):
+        with self.lock:
+            return [self.last_params(table_name, param_key)[0] for table_name, param_key in keys]
+
+    def calibration_log(self, table_name, timestamp):
+        with self.lock:
+            self._load(table_name)
+            rows = self.rows[table_name]
+            timestamps = np.memmap(self._node_directory(table_name) / "timestamp.i8",
+                                   dtype="<i8", mode="r", shape=(rows,)) if rows else np.zeros(0, dtype="<i8")
+            # the timestamps returned by insert are truncated to the microsecond
+            row = np.searchsorted(
+                timestamps, to_ns(timestamp) + 999, side="right") - 1
+            if row < 0 or timestamps[row] < to_ns(timestamp):
+                raise KeyError(f"no record of {table_name} at {timestamp}")
+            # the logs are only parsed up to the requested line
+            with open(self._node_directory(table_name) / "log.json") as f:
+                return json.loads(next(itertools.islice(f, int(row), None)))
+
+    def history_arrays(self, table_name, *args, start=None, end=None):
+        """return the records in a time range as arrays, without copying the numeric columns
+        return:
+            timestamps: int64 array of integer nanoseconds
+            values: list of arrays, float64 (NaN if missing) for numeric parameters, object otherwise
+        """
+        with self.lock:
+            meta = self._load(table_name)
+            rows = self.rows[table_name]
+            if rows == 0:
+                return np.zeros(0, dtype="<i8"), [np.zeros(0) for _ in args]
+            timestamps = np.memmap(self._node_directory(table_name) / "timestamp.i8",
+                                   dtype="<i8", mode="r", shape=(rows,))
+            first = 0 if start is None else np.searchsorted(
+                timestamps, to_ns(start), side="left")
+            last = rows if end is None else np.searchsorted(
+                timestamps, to_ns(end) + 999, side="right")
+            values = list()
+            for k in args:
+                if k not in meta["keys"]:
+                    raise KeyError(f"{k} is not a parameter of {table_name}")
+                if meta["kinds"][k] == "json":
+                    values.append(
+                        np.array(self.json_columns[table_name][k][first:last], dtype=object))
+                else:
+                    values.append(np.memmap(self._column_path(table_name, k), dtype="<f8",
+                                            mode="r", shape=(rows,))[first:last])
+            return timestamps[first:last], values
+
+    def history(self, table_name, *args, start=None, end=None):
+        timestamps, values = self.history_arrays(
+            table_name, *args, start=start, end=end)
+        # NaN marks a missing value (v != v only for NaN)
+        columns = [[None if v != v else v for v in column.tolist()]
+                   for column in values]
+        rows = zip(*columns) if columns else [()] * len(timestamps)
+        return [(from_ns(t), *row) for t, row in zip(timestamps.tolist(), rows)]
+
+    def history_buckets(self, table_name, param_key, interval, start=None, end=None):
+        """see CalibrationStorage.history_buckets, aggregated over the memory mapped columns"""
+        width = bucket_width(interval)
+        timestamps, (values,) = self.history_arrays(
+            table_name, param_key, start=start, end=end)
+        if values.dtype == object:
+            values = np.array([np.nan if v is None else v for v in values], dtype=float)
+        return bucket_arrays(timestamps, values, width, 0 if start is None else to_ns(start))
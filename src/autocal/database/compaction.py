@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+import json
+from .database import to_ns
+
+
+class Compactor:
+    """Compaction of the history in a CalibrationDatabase, in small transactions so that the writers
+    are only blocked for one batch at a time:
+    1) collapse: a record identical to the previous one and without log (a timestamp refresh by check_data)
+        is merged into the previous record, which then covers the interval [timestamp, last_refreshed];
+        the timestamp of the kept record is unchanged, so its log and scan are still found by it
+    2) downsample: of the records older than a given age, only the last one per time bucket is kept
+    The latest record of every node is never removed, so the last parameters and timestamps are unchanged.
+    The scans of the removed records in a ScanStore are not touched.
+    """
+
+    def __init__(self, database, downsample_age=None, downsample_interval=timedelta(hours=1),
+                 batch_size=500) -> None:
+        """
+        args:
+            database: the CalibrationDatabase to be compacted
+            downsample_age: timedelta, the age from which the records are downsampled, never if None
+            downsample_interval: timedelta, the duration of the buckets the old records are downsampled to
+            batch_size: number of records examined per transaction, at least 2
+        """
+        self.database = database
+        self.downsample_age = downsample_age
+        self.downsample_interval = downsample_interval
+        # a batch holds the record the previous batch ended with
+        self.batch_size = max(batch_size, 2)
+        # node_id -> (timestamp, record_id) of the last record already collapsed, where the next pass resumes
+        self.cursors = dict()
+
+    def compact(self):
+        """compact the history of all nodes
+        return:
+            number of records removed
+        """
+        with self.database.lock:
+            node_ids = list(self.database.db_con.execute(
+                "SELECT node_id FROM nodes ORDER BY node_id"))
+        removed = 0
+        for (node_id,) in node_ids:
+            while True:
+                count, done = self.collapse_batch(node_id)
+                removed += count
+                if done:
+                    break
+            if self.downsample_age is not None:
+                while True:
+                    count = self.downsample_batch(node_id)
+                    removed += count
+                    if count == 0:
+                        break
+        return removed
+
+    def _delete(self, record_ids):
+        db_con = self.database.db_con
+        rows = [(record_id,) for record_id in record_ids]
+        db_con.executemany(
+            "DELETE FROM record_values WHERE record_id=?", rows)
+        db_con.executemany("DELETE FROM logs WHERE record_id=?", rows)
+        db_con.executemany("DELETE FROM records WHERE record_id=?", rows)
+
+    def collapse_batch(self, node_id):
+        """collapse the refresh records within the next batch of records of a node, in one transaction
+        return:
+            (number of records removed, True if all records of the node are examined)
+        """
+        db_con = self.database.db_con
+        with self.database.lock, db_con:
+            cursor = self.cursors.get(node_id, (-1, -1))
+            records = db_con.execute("""SELECT r.record_id, r.timestamp, COALESCE(r.last_refreshed, r.timestamp),
+                    l.record_id IS NOT NULL FROM records r LEFT JOIN logs l ON l.record_id = r.record_id
+                WHERE r.node_id=? AND (r.timestamp, r.record_id) >= (?, ?)
+                ORDER BY r.timestamp, r.record_id LIMIT ?""",
+                                     (node_id, *cursor, self.batch_size)).fetchall()
+            if not records:
+                return 0, True
+            values = dict()
+            for record_id, param_id, value in db_con.execute(
+                    "SELECT record_id, param_id, value FROM record_values WHERE record_id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([r[0] for r in records]),)):
+                values.setdefault(record_id, dict())[param_id] = value
+            kept, kept_timestamp, kept_refreshed, _ = records[0]
+            removed = list()
+            for record_id, timestamp, last_refreshed, has_log in records[1:]:
+                if not has_log and values.get(record_id) == values.get(kept):
+                    # the interval of the kept record extends to this refresh
+                    removed.append(record_id)
+                    kept_refreshed = last_refreshed
+                    continue
+                self._extend(kept, kept_refreshed)
+                kept, kept_timestamp, kept_refreshed = record_id, timestamp, last_refreshed
+            self._extend(kept, kept_refreshed)
+            self._delete(removed)
+            self.cursors[node_id] = (kept_timestamp, kept)
+            return len(removed), len(records) < self.batch_size
+
+    def _extend(self, record_id, last_refreshed):
+        self.database.db_con.execute("""UPDATE records SET last_refreshed=:last_refreshed
+            WHERE record_id=:record_id AND COALESCE(last_refreshed, timestamp) != :last_refreshed""",
+                                     {"record_id": record_id, "last_refreshed": last_refreshed})
+
+    def downsample_batch(self, node_id):
+        """remove a batch of old records of a node, keeping the last one of every bucket, in one transaction
+        return:
+            number of records removed
+        """
+        width = self.downsample_interval // timedelta(microseconds=1) * 1000
+        db_con = self.database.db_con
+        with self.database.lock, db_con:
+            horizon = to_ns(datetime.now() - self.downsample_age)
+            # the latest record is kept even if old, it holds the current parameters
+            latest = db_con.execute("SELECT record_id FROM records WHERE node_id=? ORDER BY timestamp DESC, record_id DESC LIMIT 1",
+                                    (node_id,)).fetchone()
+            record_ids = [row[0] for row in db_con.execute("""SELECT record_id FROM (
+                    SELECT record_id, ROW_NUMBER() OVER (PARTITION BY timestamp / :width
+                        ORDER BY timestamp DESC, record_id DESC) AS rank
+                    FROM records WHERE node_id = :node_id AND timestamp < :horizon)
+                WHERE rank > 1 AND record_id != :latest LIMIT :batch_size""",
+                                                           {"width": width, "node_id": node_id, "horizon": horizon,
+                                                            "latest": -1 if latest is None else latest[0],
+                                                            "batch_size": self.batch_size})]
+            self._delete(record_ids)
+            return len(record_ids)
@@ -1,38 +1,447 @@
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+import numpy as np
+from .buckets import HistoryBuckets, bucket_width
+from .storage import validate_name
+
+# format of the timestamps stored as TEXT in the legacy per-node tables
+TEXT_TIMESTAMP_FORMAT = '%Y-%m-%d-%H:%M:%S:%f'
+# suffix of the legacy per-node tables, the time the DAG was built
+LEGACY_TABLE_SUFFIX = re.compile(r"_\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}$")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS nodes (
+        node_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)""",
+    """CREATE TABLE IF NOT EXISTS parameters (
+        param_id INTEGER PRIMARY KEY,
+        node_id INTEGER NOT NULL REFERENCES nodes (node_id),
+        name TEXT NOT NULL,
+        UNIQUE (node_id, name))""",
+    """CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY,
+        started INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS records (
+        record_id INTEGER PRIMARY KEY,
+        node_id INTEGER NOT NULL REFERENCES nodes (node_id),
+        run_id INTEGER NOT NULL REFERENCES runs (run_id),
+        timestamp INTEGER NOT NULL,
+        last_refreshed INTEGER)""",
+    "CREATE INDEX IF NOT EXISTS records_node_timestamp ON records (node_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS records_run ON records (run_id, node_id)",
+    """CREATE TABLE IF NOT EXISTS record_values (
+        record_id INTEGER NOT NULL REFERENCES records (record_id),
+        param_id INTEGER NOT NULL REFERENCES parameters (param_id),
+        value REAL,
+        PRIMARY KEY (record_id, param_id)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS logs (
+        record_id INTEGER PRIMARY KEY REFERENCES records (record_id),
+        log BLOB NOT NULL)""",
+)
+# the statements of the frequent calls, with a fixed text so that the prepared statements are reused
+# from the statement cache of the connection; the lists of ids are passed as one JSON array
+# a collapsed record was last refreshed at the end of its interval
+LAST_TIMESTAMP = """SELECT COALESCE(last_refreshed, timestamp) FROM records
+    WHERE node_id=? ORDER BY timestamp DESC LIMIT 1"""
+LAST_VALUES = """SELECT r.node_id, v.param_id, v.value FROM json_each(?) n
+    JOIN records r ON r.record_id = (
+        SELECT record_id FROM records WHERE node_id=n.value ORDER BY timestamp DESC LIMIT 1)
+    JOIN record_values v ON v.record_id = r.record_id"""
+# the newest row of the records, which changes with every insert and every update of an interval
+STATE_MARKER = "SELECT record_id, COALESCE(last_refreshed, timestamp) FROM records ORDER BY record_id DESC LIMIT 1"
+INSERT_RECORD = "INSERT INTO records (node_id, run_id, timestamp) VALUES (?, ?, ?)"
+INSERT_VALUE = "INSERT INTO record_values (record_id, param_id, value) VALUES (?, ?, ?)"
+INSERT_LOG = "INSERT INTO logs (record_id, log) VALUES (?, ?)"
+HISTORY_RECORDS = """SELECT record_id, timestamp FROM records
+    WHERE node_id=? AND timestamp BETWEEN ? AND ? ORDER BY timestamp, record_id"""
+HISTORY_VALUES = """SELECT v.record_id, v.param_id, v.value
+    FROM records r JOIN record_values v ON v.record_id = r.record_id
+    WHERE r.node_id=? AND r.timestamp BETWEEN ? AND ? AND v.param_id IN (SELECT value FROM json_each(?))"""
+SCHEMA_TABLES = ("nodes", "parameters", "runs",
+                 "records", "record_values", "logs")
+
+
+def quote_identifier(name):
+    """quote a table or column name of a legacy table, which could not be passed as a parameter"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def to_ns(timestamp):
+    """convert a (naive, local) datetime to integer nanoseconds since the epoch"""
+    return int(timestamp.replace(microsecond=0).timestamp()) * 10**9 + timestamp.microsecond * 1000
+
+
+def from_ns(ns):
+    """convert integer nanoseconds since the epoch to a (naive, local) datetime"""
+    return datetime.fromtimestamp(ns // 10**9).replace(microsecond=ns % 10**9 // 1000)
 
 
 class CalibrationDatabase:
-    def __init__(self, db_con) -> None:
-        self.db_con = db_con
+    """The calibration records of all nodes, in a schema shared by all runs:
+        nodes: one row per calibration node
+        parameters: one row per parameter of a node
+        runs: one row per start of the calibration service
+        records: one row per update of a node, keyed by (node_id, run_id, timestamp),
+            or per interval [timestamp, last_refreshed] of identical updates after compaction
+        record_values: the value of every parameter in a record
+        logs: the zlib compressed calibration log of a record, only read on request
+    A node keeps its history across restarts, so the last parameters are resumed at startup.
+    The table_name arguments of the methods refer to the node names.
+    The database owns its connections: the database file is in WAL mode, the writes (and the reads
+    of the last records) go through one writer connection shared by all threads, while the history
+    queries use a pool of read-only connections, thus never block the calibration writes.
+    """
+
+    def __init__(self, database_address, read_pool_size=4) -> None:
+        """
+        args:
+            database_address: path to the database file, or ":memory:" for a private in-memory database
+                (without read-only connections)
+            read_pool_size: maximal number of read-only connections
+        """
+        self.database_address = str(database_address)
+        self.in_memory = self.database_address == ":memory:"
+        self.db_con = sqlite3.connect(
+            self.database_address, check_same_thread=False)
+        if not self.in_memory:
+            self.db_con.execute("PRAGMA journal_mode=WAL")
+            # durable in WAL mode, without a sync at every commit
+            self.db_con.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.RLock()
+        self.read_pool = queue.LifoQueue()
+        self.read_pool_size = read_pool_size
+        self.read_connections = list()
+        # node name -> node_id, and node name -> {parameter name -> param_id}
+        self.node_ids = dict()
+        self.param_ids = dict()
+        self.run_id = None
+        with self.lock, self.db_con:
+            for statement in SCHEMA:
+                self.db_con.execute(statement)
+            self._introspect()
+
+    def close(self):
+        """close the writer and all read-only connections"""
+        with self.lock:
+            for con in self.read_connections:
+                con.close()
+            self.read_connections.clear()
+            self.db_con.close()
+
+    @contextmanager
+    def reader(self):
+        """context manager handing out a pooled read-only connection, e.g. for dashboards
+        it blocks if all read_pool_size connections are in use
+        """
+        if self.in_memory:
+            # an in-memory database could not be opened twice
+            with self.lock:
+                yield self.db_con
+            return
+        try:
+            con = self.read_pool.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if len(self.read_connections) < self.read_pool_size:
+                    con = sqlite3.connect(f"{Path(self.database_address).resolve().as_uri()}?mode=ro",
+                                          uri=True, check_same_thread=False)
+                    self.read_connections.append(con)
+                else:
+                    con = None
+            if con is None:
+                con = self.read_pool.get()
+        try:
+            yield con
+        finally:
+            self.read_pool.put(con)
 
     def initialize_table(self, table_name, var_keys):
-        # Primary key is timestamp
-        self.db_con.execute(
-            f"""CREATE TABLE IF NOT EXISTS {table_name} (
-                timestamp TEXT PRIMARY KEY,
-                calibration_log TEXT)""")
-        for var_key in var_keys:
-            self.db_con.execute(f"ALTER TABLE {table_name} ADD {var_key} REAL")
+        """register a node and its parameters, the existing history of the node is kept"""
+        self.initialize_tables({table_name: var_keys})
+
+    def initialize_tables(self, tables):
+        """register several nodes and their parameters in one transaction, idempotent
+        args:
+            tables: dictionary of node name -> parameter names
+        """
+        with self.lock:
+            missing = {table_name: [k for k in var_keys if k not in self.param_ids.get(table_name, ())]
+                       for table_name, var_keys in tables.items()}
+            missing = {table_name: var_keys for table_name, var_keys in missing.items()
+                       if var_keys or table_name not in self.node_ids}
+            if not missing:
+                return  # all registered already, no statement at all
+            # the names are validated once, when registered
+            for table_name, var_keys in missing.items():
+                validate_name(table_name)
+                for var_key in var_keys:
+                    validate_name(var_key)
+            with self.db_con:
+                self._register(missing)
+
+    def _register(self, tables):
+        self.db_con.executemany("INSERT OR IGNORE INTO nodes (name) VALUES (?)",
+                                [(table_name,) for table_name in tables])
+        self._introspect(tables)
+        self.db_con.executemany("INSERT OR IGNORE INTO parameters (node_id, name) VALUES (?, ?)",
+                                [(self.node_ids[table_name], var_key)
+                                 for table_name, var_keys in tables.items() for var_key in var_keys])
+        self._introspect(tables)
+
+    def _introspect(self, table_names=None):
+        """cache the ids of the given nodes (all nodes if None) and their parameters, in two queries"""
+        if table_names is None:
+            node_ids = self.db_con.execute(
+                "SELECT name, node_id FROM nodes").fetchall()
+        else:
+            node_ids = self.db_con.execute("SELECT name, node_id FROM nodes WHERE name IN (SELECT value FROM json_each(?))",
+                                           (json.dumps(list(table_names)),)).fetchall()
+        names = {node_id: table_name for table_name, node_id in node_ids}
+        self.node_ids.update(node_ids)
+        self.param_ids.update({table_name: dict() for table_name, _ in node_ids})
+        for node_id, name, param_id in self.db_con.execute(
+                "SELECT node_id, name, param_id FROM parameters WHERE node_id IN (SELECT value FROM json_each(?)) ORDER BY param_id",
+                (json.dumps(list(names)),)):
+            self.param_ids[names[node_id]][name] = param_id
+
+    def _load_node(self, table_name):
+        """cache the ids of a node and its parameters, return the node_id"""
+        row = self.db_con.execute(
+            "SELECT node_id FROM nodes WHERE name=?", (table_name,)).fetchone()
+        if row is None:
+            raise KeyError(
+                f"calibration node {table_name} is not initialized")
+        self.node_ids[table_name] = row[0]
+        self.param_ids[table_name] = dict(self.db_con.execute(
+            "SELECT name, param_id FROM parameters WHERE node_id=? ORDER BY param_id", (row[0],)).fetchall())
+        return row[0]
+
+    def _node_id(self, table_name):
+        if table_name in self.node_ids:
+            return self.node_ids[table_name]
+        return self._load_node(table_name)
+
+    def _param_id(self, table_name, param_key):
+        self._node_id(table_name)
+        try:
+            return self.param_ids[table_name][param_key]
+        except KeyError:
+            raise KeyError(f"{param_key} is not a parameter of {table_name}")
+
+    def _current_run(self):
+        """the run of this database object, created with its first record"""
+        if self.run_id is None:
+            self.run_id = self.db_con.execute(
+                "INSERT INTO runs (started) VALUES (?)", (time.time_ns(),)).lastrowid
+        return self.run_id
+
+    def data_version(self):
+        """return a number which changes whenever another connection commits to the database"""
+        with self.lock:
+            return self.db_con.execute("PRAGMA data_version").fetchone()[0]
+
+    def state_marker(self):
+        """return a marker of the records, which changes with every write to them, also across restarts:
+        the id of the newest record and the end of its interval (as a record id could be reused after compaction)
+        """
+        with self.lock:
+            row = self.db_con.execute(STATE_MARKER).fetchone()
+        return [] if row is None else list(row)
 
     def last_timestamp(self, table_name):
-        text_format = self.db_con.execute(
-            f"SELECT timestamp FROM {table_name} ORDER BY ROWID DESC LIMIT 1").fetchone()[0]
-        return datetime.strptime(text_format, '%Y-%m-%d-%H:%M:%S:%f')
+        """return the datetime of the last record, or None if there is no record"""
+        with self.lock:
+            row = self.db_con.execute(
+                LAST_TIMESTAMP, (self._node_id(table_name),)).fetchone()
+        if row is None:
+            return None
+        return from_ns(row[0])
+
+    def _last_values(self, node_ids):
+        """return {(node_id, param_id) -> value} of the last records of the nodes, in one query"""
+        rows = self.db_con.execute(
+            LAST_VALUES, (json.dumps(list(node_ids)),)).fetchall()
+        return {(node_id, param_id): value for node_id, param_id, value in rows}
 
     def last_params(self, table_name, *args):
-        query_result = list()
-        for param_key in args:
-            command = f"SELECT {param_key} FROM {table_name} ORDER BY ROWID DESC LIMIT 1"
-            query_result.append(self.db_con.execute(command).fetchone()[0])
-        return query_result
-
-    def insert(self, table_name, var_dict, calibration_log=""):
-        # create timestamp and a new row
-        timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S:%f')
-        self.db_con.execute(
-            f"INSERT INTO {table_name} (timestamp) values (?)", (timestamp,))
-        for var_name, var_value in var_dict.items():
-            self.db_con.execute(f"UPDATE {table_name} SET {var_name}=? WHERE timestamp=?",
-                                (var_value, timestamp))
-        self.db_con.execute(f"UPDATE {table_name} SET calibration_log=? WHERE timestamp=?",
-                            (calibration_log, timestamp))
+        """return the values of the given parameters in the last record, fetched in one query"""
+        with self.lock:
+            node_id = self._node_id(table_name)
+            param_ids = [self._param_id(table_name, k) for k in args]
+            if not param_ids:
+                return list()
+            values = self._last_values([node_id])
+        return [values.get((node_id, param_id)) for param_id in param_ids]
+
+    def last_record(self, table_name):
+        """return the last record as a dictionary of parameter name -> value, or None if there is no record"""
+        with self.lock:
+            node_id = self._node_id(table_name)
+            if self.last_timestamp(table_name) is None:
+                return None
+            values = self._last_values([node_id])
+            return {k: values.get((node_id, param_id)) for k, param_id in self.param_ids[table_name].items()}
+
+    def last_params_many(self, keys):
+        """return the last values of parameters from several nodes, fetched in one query
+        args:
+            keys: iterable of (table_name, param_key)
+        """
+        with self.lock:
+            ids = [(self._node_id(table_name), self._param_id(table_name, param_key))
+                   for table_name, param_key in keys]
+            if not ids:
+                return list()
+            values = self._last_values(list({node_id for node_id, _ in ids}))
+        return [values.get(key) for key in ids]
+
+    def history(self, table_name, *args, start=None, end=None):
+        """return the records of the given parameters in a time range, over all runs
+        args:
+            start, end: datetime, the bounds (included, to the microsecond) of the range, unbounded if None
+        return:
+            list of (timestamp, value1, value2, ...), in chronological order
+        """
+        start = 0 if start is None else to_ns(start)
+        end = 2**63 - 1 if end is None else to_ns(end) + 999
+        with self.lock:
+            node_id = self._node_id(table_name)
+            param_ids = [self._param_id(table_name, k) for k in args]
+        with self.reader() as con:
+            records = con.execute(
+                HISTORY_RECORDS, (node_id, start, end)).fetchall()
+            values = dict()
+            if records and param_ids:
+                rows = con.execute(HISTORY_VALUES,
+                                   (node_id, start, end, json.dumps(param_ids))).fetchall()
+                values = {(record_id, param_id): value for record_id,
+                          param_id, value in rows}
+        return [(from_ns(timestamp), *[values.get((record_id, param_id)) for param_id in param_ids])
+                for record_id, timestamp in records]
+
+    def history_buckets(self, table_name, param_key, interval, start=None, end=None):
+        """see CalibrationStorage.history_buckets"""
+        width = bucket_width(interval)
+        start = 0 if start is None else to_ns(start)
+        end = 2**63 - 1 if end is None else to_ns(end) + 999
+        with self.lock:
+            node_id = self._node_id(table_name)
+            param_id = self._param_id(table_name, param_key)
+        with self.reader() as con:
+            # the aggregation runs in SQLite, only one row per bucket is transferred
+            rows = con.execute("""SELECT bucket, COUNT(*), MIN(value), MAX(value), AVG(value), MAX(last) FROM (
+                    SELECT (r.timestamp - :start) / :width AS bucket, v.value AS value,
+                        FIRST_VALUE(v.value) OVER (PARTITION BY (r.timestamp - :start) / :width
+                            ORDER BY r.timestamp DESC, r.record_id DESC) AS last
+                    FROM records r JOIN record_values v ON v.record_id = r.record_id
+                    WHERE r.node_id = :node_id AND v.param_id = :param_id AND v.value IS NOT NULL
+                        AND r.timestamp BETWEEN :start AND :end)
+                GROUP BY bucket ORDER BY bucket""",
+                               {"start": start, "end": end, "width": width,
+                                "node_id": node_id, "param_id": param_id}).fetchall()
+        columns = list(zip(*rows)) if rows else [()] * 6
+        return HistoryBuckets(start=start + np.array(columns[0], dtype=np.int64) * width,
+                              count=np.array(columns[1], dtype=np.int64),
+                              **{field: np.array(column, dtype=float)
+                                 for field, column in zip(("min", "max", "mean", "last"), columns[2:])})
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        """insert a new record of a node, in one transaction
+        args:
+            timestamp: datetime of the record, now if None
+        return:
+            the timestamp of the record
+        """
+        with self.lock, self.db_con:
+            return self._insert(table_name, var_dict, calibration_log, timestamp)
+
+    def insert_many(self, records):
+        """insert several records, e.g. the results of several nodes, in a single transaction
+        args:
+            records: iterable of (table_name, var_dict, calibration_log), or
+                (table_name, var_dict, calibration_log, timestamp)
+        return:
+            list of the timestamps of the records
+        """
+        with self.lock, self.db_con:
+            return [self._insert(*record) for record in records]
+
+    def _insert(self, table_name, var_dict, calibration_log, timestamp=None):
+        node_id = self._node_id(table_name)
+        values = [(self._param_id(table_name, k), v)
+                  for k, v in var_dict.items()]
+        timestamp = time.time_ns() if timestamp is None else to_ns(timestamp)
+        record_id = self.db_con.execute(
+            INSERT_RECORD, (node_id, self._current_run(), timestamp)).lastrowid
+        self.db_con.executemany(INSERT_VALUE,
+                                [(record_id, param_id, value) for param_id, value in values])
+        self._insert_log(record_id, calibration_log)
+        return from_ns(timestamp)
+
+    def _insert_log(self, record_id, calibration_log):
+        # most records (e.g. refreshes by check_data) have no log, which takes no row
+        if calibration_log:
+            self.db_con.execute(
+                INSERT_LOG, (record_id, zlib.compress(calibration_log.encode())))
+
+    def calibration_log(self, table_name, timestamp):
+        """return the calibration log of the record at a timestamp (to the microsecond),
+        raise KeyError if there is no such record
+        """
+        with self.lock:
+            node_id = self._node_id(table_name)
+        with self.reader() as con:
+            row = con.execute("""SELECT r.record_id, l.log FROM records r LEFT JOIN logs l ON l.record_id = r.record_id
+                WHERE r.node_id=? AND r.timestamp BETWEEN ? AND ? ORDER BY r.timestamp DESC, r.record_id DESC LIMIT 1""",
+                              (node_id, to_ns(timestamp), to_ns(timestamp) + 999)).fetchone()
+        if row is None:
+            raise KeyError(f"no record of {table_name} at {timestamp}")
+        return "" if row[1] is None else zlib.decompress(row[1]).decode()
+
+    def migrate_legacy_tables(self):
+        """import the legacy tables (one table per node per startup, named {node}_{YYYY_MM_DD_HH_MM_SS},
+        with TEXT timestamps) into the shared schema, one run per table,
+        and drop them afterwards.
+        return:
+            list of the names of the migrated tables
+        """
+        migrated = list()
+        with self.lock, self.db_con:
+            tables = [row[0] for row in self.db_con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            for legacy_table in tables:
+                if legacy_table in SCHEMA_TABLES:
+                    continue
+                columns = [row[0] for row in self.db_con.execute(
+                    "SELECT name FROM pragma_table_info(?)", (legacy_table,))]
+                if "timestamp" not in columns or "calibration_log" not in columns:
+                    continue
+                table_name = LEGACY_TABLE_SUFFIX.sub("", legacy_table)
+                keys = [k for k in columns if k not in (
+                    "timestamp", "calibration_log")]
+                self._register({table_name: keys})
+                rows = self.db_con.execute(
+                    f"SELECT timestamp, calibration_log, {', '.join(map(quote_identifier, keys)) or 'NULL'} "
+                    f"FROM {quote_identifier(legacy_table)} ORDER BY ROWID").fetchall()
+                timestamps = [to_ns(datetime.strptime(row[0], TEXT_TIMESTAMP_FORMAT)) for row in rows]
+                run_id = self.db_con.execute("INSERT INTO runs (started) VALUES (?)",
+                                             (timestamps[0] if timestamps else time.time_ns(),)).lastrowid
+                for row, timestamp in zip(rows, timestamps):
+                    record_id = self.db_con.execute(
+                        INSERT_RECORD, (self.node_ids[table_name], run_id, timestamp)).lastrowid
+                    self._insert_log(record_id, row[1])
+                    self.db_con.executemany(INSERT_VALUE,
+                                            [(record_id, self.param_ids[table_name][k], v)
+                                             for k, v in zip(keys, row[2:]) if v is not None])
+                self.db_con.execute(
+                    f"DROP TABLE {quote_identifier(legacy_table)}")
+                migrated.append(legacy_table)
+        return migrated
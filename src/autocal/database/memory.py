@@ -0,0 +1,137 @@
+from bisect import bisect_left, bisect_right
+import threading
+import time
+import numpy as np
+from .database import to_ns, from_ns
+from .storage import validate_name
+from .buckets import bucket_width, bucket_arrays
+
+
+class InMemoryDatabase:
+    """Pure in-memory implementation of CalibrationStorage, for tests and simulations.
+    The records of every node are kept in chronological order, thus history queries are binary searches.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        # node name -> list of parameter names
+        self.keys = dict()
+        # node name -> list of integer nanoseconds timestamps / list of dictionaries of values / list of logs
+        self.timestamps = dict()
+        self.records = dict()
+        self.logs = dict()
+
+    def initialize_table(self, table_name, var_keys):
+        validate_name(table_name)
+        for k in var_keys:
+            validate_name(k)
+        with self.lock:
+            keys = self.keys.setdefault(table_name, list())
+            keys.extend(k for k in var_keys if k not in keys)
+            self.timestamps.setdefault(table_name, list())
+            self.records.setdefault(table_name, list())
+            self.logs.setdefault(table_name, list())
+
+    def initialize_tables(self, tables):
+        with self.lock:
+            for table_name, var_keys in tables.items():
+                self.initialize_table(table_name, var_keys)
+
+    def _keys(self, table_name):
+        if table_name not in self.keys:
+            raise KeyError(
+                f"calibration node {table_name} is not initialized")
+        return self.keys[table_name]
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        with self.lock:
+            return self._insert(table_name, var_dict, calibration_log, timestamp)
+
+    def insert_many(self, records):
+        records = list(records)
+        with self.lock:
+            # validate all records first, so that a failing record inserts nothing
+            for record in records:
+                self._validate(record[0], record[1])
+            return [self._insert(*record) for record in records]
+
+    def _validate(self, table_name, var_dict):
+        keys = self._keys(table_name)
+        for k in var_dict:
+            if k not in keys:
+                raise KeyError(f"{k} is not a parameter of {table_name}")
+
+    def _insert(self, table_name, var_dict, calibration_log, timestamp=None):
+        self._validate(table_name, var_dict)
+        timestamp = time.time_ns() if timestamp is None else to_ns(timestamp)
+        timestamps = self.timestamps[table_name]
+        i = bisect_right(timestamps, timestamp)
+        timestamps.insert(i, timestamp)
+        self.records[table_name].insert(i, dict(var_dict))
+        self.logs[table_name].insert(i, calibration_log)
+        return from_ns(timestamp)
+
+    def last_timestamp(self, table_name):
+        with self.lock:
+            self._keys(table_name)
+            timestamps = self.timestamps[table_name]
+            return from_ns(timestamps[-1]) if timestamps else None
+
+    def last_params(self, table_name, *args):
+        with self.lock:
+            keys = self._keys(table_name)
+            for k in args:
+                if k not in keys:
+                    raise KeyError(f"{k} is not a parameter of {table_name}")
+            records = self.records[table_name]
+            last = records[-1] if records else dict()
+            return [last.get(k) for k in args]
+
+    def last_record(self, table_name):
+        with self.lock:
+            keys = self._keys(table_name)
+            records = self.records[table_name]
+            if not records:
+                return None
+            return {k: records[-1].get(k) for k in keys}
+
+    def last_params_many(self, keys):
+        with self.lock:
+            return [self.last_params(table_name, param_key)[0] for table_name, param_key in keys]
+
+    def calibration_log(self, table_name, timestamp):
+        with self.lock:
+            self._keys(table_name)
+            timestamps = self.timestamps[table_name]
+            # the timestamps returned by insert are truncated to the microsecond
+            i = bisect_right(timestamps, to_ns(timestamp) + 999) - 1
+            if i < 0 or timestamps[i] < to_ns(timestamp):
+                raise KeyError(f"no record of {table_name} at {timestamp}")
+            return self.logs[table_name][i]
+
+    def history(self, table_name, *args, start=None, end=None):
+        with self.lock:
+            self._keys(table_name)
+            timestamps = self.timestamps[table_name]
+            first = 0 if start is None else bisect_left(
+                timestamps, to_ns(start))
+            last = len(timestamps) if end is None else bisect_right(
+                timestamps, to_ns(end) + 999)
+            return [(from_ns(timestamps[i]), *[self.records[table_name][i].get(k) for k in args])
+                    for i in range(first, last)]
+
+    def history_buckets(self, table_name, param_key, interval, start=None, end=None):
+        """see CalibrationStorage.history_buckets"""
+        width = bucket_width(interval)
+        origin = 0 if start is None else to_ns(start)
+        with self.lock:
+            if param_key not in self._keys(table_name):
+                raise KeyError(f"{param_key} is not a parameter of {table_name}")
+            timestamps = self.timestamps[table_name]
+            first = bisect_left(timestamps, origin)
+            last = len(timestamps) if end is None else bisect_right(
+                timestamps, to_ns(end) + 999)
+            values = [self.records[table_name][i].get(param_key)
+                      for i in range(first, last)]
+            return bucket_arrays(np.array(timestamps[first:last], dtype=np.int64),
+                                 [np.nan if v is None else v for v in values], width, origin)
@@ -0,0 +1,82 @@
+from pathlib import Path
+import os
+import numpy as np
+from .database import to_ns, from_ns
+
+
+class ScanStore:
+    """Raw data of the scans (x_data, y_data), complex IQ traces included, with one directory per node
+    and the files of a scan named by the timestamp of its record in integer nanoseconds:
+        {timestamp}.x.npy, {timestamp}.y.npy: uncompressed, read back through memory mapping without copies
+        {timestamp}.npz: compressed, decompressed into memory on reading
+    Refitting or studying the drift over large archives thus neither measures again nor loads all scans into RAM.
+    """
+
+    def __init__(self, directory, compress=False) -> None:
+        """
+        args:
+            directory: the root directory of the store, created if not existing
+            compress: if the scans are saved compressed, trading the memory mapping for disk space
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+
+    def _node_directory(self, table_name):
+        return self.directory / table_name
+
+    def save(self, table_name, timestamp, x_data, y_data):
+        """save the scan of a record, return its key in integer nanoseconds"""
+        key = to_ns(timestamp)
+        node_directory = self._node_directory(table_name)
+        node_directory.mkdir(exist_ok=True)
+        x_data, y_data = np.asarray(x_data), np.asarray(y_data)
+        if self.compress:
+            path = node_directory / f"{key}.npz"
+            with open(path.with_suffix(".tmp"), "wb") as f:
+                np.savez_compressed(f, x=x_data, y=y_data)
+            os.replace(path.with_suffix(".tmp"), path)
+        else:
+            # x is written last, it marks the scan as complete
+            np.save(node_directory / f"{key}.y.npy", y_data)
+            np.save(node_directory / f"{key}.x.npy", x_data)
+        return key
+
+    def keys(self, table_name, start=None, end=None):
+        """return the keys of the saved scans in a time range, in chronological order"""
+        node_directory = self._node_directory(table_name)
+        if not node_directory.exists():
+            return list()
+        keys = sorted({int(path.name.split(".")[0]) for pattern in ("*.x.npy", "*.npz")
+                       for path in node_directory.glob(pattern)})
+        first = None if start is None else to_ns(start)
+        # the whole microsecond of the end bound is included
+        last = None if end is None else to_ns(end) + 999
+        return [k for k in keys
+                if (first is None or k >= first) and (last is None or k <= last)]
+
+    def timestamps(self, table_name, start=None, end=None):
+        """return the timestamps of the saved scans in a time range, in chronological order"""
+        return [from_ns(k) for k in self.keys(table_name, start, end)]
+
+    def load(self, table_name, timestamp):
+        """return the scan (x_data, y_data) of a record, raise KeyError if it was not saved
+        args:
+            timestamp: the datetime of the record, or its key in integer nanoseconds
+        """
+        key = timestamp if isinstance(timestamp, int) else to_ns(timestamp)
+        node_directory = self._node_directory(table_name)
+        path = node_directory / f"{key}.x.npy"
+        if path.exists():
+            return (np.load(path, mmap_mode="r", allow_pickle=False),
+                    np.load(node_directory / f"{key}.y.npy", mmap_mode="r", allow_pickle=False))
+        path = node_directory / f"{key}.npz"
+        if path.exists():
+            with np.load(path, allow_pickle=False) as scan:
+                return scan["x"], scan["y"]
+        raise KeyError(f"no scan of {table_name} at {from_ns(key)}")
+
+    def scans(self, table_name, start=None, end=None):
+        """iterate over (timestamp, x_data, y_data) of the scans in a time range, loading one scan at a time"""
+        for key in self.keys(table_name, start, end):
+            yield (from_ns(key), *self.load(table_name, key))
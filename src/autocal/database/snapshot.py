@@ -0,0 +1,143 @@
+from pathlib import Path
+import json
+import os
+import struct
+import typing
+from .database import to_ns, from_ns
+
+# file signature and version of the snapshot format
+SNAPSHOT_MAGIC = b"ACSNAP02"
+# tags of the parameter values: float64, int64, missing, JSON text (bool, str, ...)
+FLOAT, INT, NONE, JSON = b"d", b"q", b"n", b"j"
+# the timestamps of the nodes never calibrated
+NO_TIMESTAMP = -1
+
+
+def _pack_str(text):
+    data = text.encode()
+    return struct.pack("<I", len(data)) + data
+
+
+def _pack_value(value):
+    if value is None:
+        return NONE
+    if isinstance(value, float):
+        return FLOAT + struct.pack("<d", value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return INT + struct.pack("<q", value)
+    return JSON + _pack_str(json.dumps(value))
+
+
+class Snapshot(typing.NamedTuple):
+    """the content of a snapshot file, see write_snapshot"""
+    records: dict
+    marker: typing.Any
+
+
+def write_snapshot(path, records, marker=None):
+    """write the state of all nodes into one file, atomically: the file is either the old or the new snapshot
+    args:
+        records: dictionary of node name -> (timestamp, expiry, dictionary of parameter name -> value),
+            with None for the timestamp, expiry and parameters of a node never calibrated
+        marker: JSON serializable state of the database the records are read from (see state_marker),
+            the snapshot is only valid as long as the database has the same marker
+    """
+    chunks = [SNAPSHOT_MAGIC, _pack_str(json.dumps(marker)),
+              struct.pack("<I", len(records))]
+    for table_name, (timestamp, expiry, params) in records.items():
+        params = dict() if params is None else params
+        chunks.append(_pack_str(table_name))
+        chunks.append(struct.pack("<qqi",
+                                  NO_TIMESTAMP if timestamp is None else to_ns(timestamp),
+                                  NO_TIMESTAMP if expiry is None else to_ns(expiry),
+                                  len(params) if timestamp is not None else -1))
+        for key, value in params.items():
+            chunks.append(_pack_str(key))
+            chunks.append(_pack_value(value))
+    path = Path(path)
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "wb") as f:
+        f.write(b"".join(chunks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class _Reader:
+    def __init__(self, data) -> None:
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def bytes(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError("truncated snapshot")
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def str(self):
+        return self.bytes(self.unpack("<I")[0]).decode()
+
+    def value(self):
+        tag = self.bytes(1)
+        if tag == NONE:
+            return None
+        if tag == FLOAT:
+            return self.unpack("<d")[0]
+        if tag == INT:
+            return self.unpack("<q")[0]
+        if tag == JSON:
+            return json.loads(self.str())
+        raise ValueError(f"unknown value tag {tag}")
+
+
+def read_snapshot(path):
+    """read a snapshot in one read
+    return:
+        Snapshot of the records, dictionary of node name -> (timestamp, expiry, dictionary of parameter name -> value),
+        and of the marker of the database, see write_snapshot
+    raise:
+        ValueError if the file is not a valid snapshot
+    """
+    reader = _Reader(Path(path).read_bytes())
+    if reader.bytes(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a calibration snapshot")
+    records = dict()
+    try:
+        marker = json.loads(reader.str())
+        for _ in range(reader.unpack("<I")[0]):
+            table_name = reader.str()
+            timestamp, expiry, count = reader.unpack("<qqi")
+            params = None if count < 0 else {reader.str(): reader.value()
+                                             for _ in range(count)}
+            records[table_name] = (None if timestamp == NO_TIMESTAMP else from_ns(timestamp),
+                                   None if expiry == NO_TIMESTAMP else from_ns(
+                                       expiry),
+                                   params)
+    except struct.error:
+        raise ValueError("truncated snapshot")
+    return Snapshot(records, marker)
+
+
+def save_snapshot(path, dag_container):
+    """write the snapshot of the last records of all nodes of a DAG, see write_snapshot
+    the marker is read before the records, so that a record written meanwhile invalidates the snapshot
+    """
+    records = dict()
+    marker = None
+    for node in dag_container.values():
+        if hasattr(node.database, "state_marker"):
+            marker = node.database.state_marker()
+            break
+    for node in dag_container.values():
+        database = node.database
+        timestamp = database.last_timestamp(node.table_name)
+        records[node.table_name] = (timestamp,
+                                    getattr(node, "expiry", None),
+                                    database.last_record(node.table_name))
+    write_snapshot(path, records, marker)
@@ -0,0 +1,73 @@
+import re
+import typing
+
+# the names of the nodes and parameters: no "-", which separates them in "node - parameter" keys,
+# no path separator, as the columnar and scan stores keep one directory per node,
+# "@" is allowed for the nodes instantiated from templates, e.g. "Rabi@q1"
+NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_@. ]*(?<![ .])$")
+
+
+def validate_name(name):
+    """raise a ValueError if name is not a valid node or parameter name, see NAME_PATTERN"""
+    if not isinstance(name, str) or NAME_PATTERN.match(name) is None:
+        raise ValueError(f"{name!r} is not a valid node or parameter name")
+
+
+@typing.runtime_checkable
+class CalibrationStorage(typing.Protocol):
+    """The storage interface the calibration nodes depend on, implemented by
+        CalibrationDatabase: SQLite, the default
+        InMemoryDatabase: pure in-memory, for tests and simulations
+        ColumnarDatabase: append-only NumPy arrays on disk, for analytics over long histories
+    The table_name arguments refer to the node names, the timestamps are (naive, local) datetimes.
+    """
+
+    def initialize_table(self, table_name, var_keys):
+        """register a node and its parameters, the existing history of the node is kept"""
+        ...
+
+    def initialize_tables(self, tables):
+        """register several nodes at once, tables being a dictionary of node name -> parameter names"""
+        ...
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        """insert a new record of a node, return its timestamp"""
+        ...
+
+    def insert_many(self, records):
+        """insert several records of (table_name, var_dict, calibration_log[, timestamp]), return their timestamps"""
+        ...
+
+    def last_timestamp(self, table_name):
+        """return the datetime of the last record, or None if there is no record"""
+        ...
+
+    def last_params(self, table_name, *args):
+        """return the values of the given parameters in the last record, an empty list if none is given"""
+        ...
+
+    def last_record(self, table_name):
+        """return the last record as a dictionary of parameter name -> value, or None if there is no record"""
+        ...
+
+    def last_params_many(self, keys):
+        """return the last values of parameters, keys being an iterable of (table_name, param_key)"""
+        ...
+
+    def calibration_log(self, table_name, timestamp):
+        """return the calibration log of the record at a timestamp (to the microsecond), raise KeyError if there is no such record"""
+        ...
+
+    def history(self, table_name, *args, start=None, end=None):
+        """return the list of (timestamp, value1, value2, ...) of the records in a time range, in chronological order"""
+        ...
+
+    def history_buckets(self, table_name, param_key, interval, start=None, end=None):
+        """return the history of a parameter in a time range, aggregated over buckets of a given duration
+        args:
+            interval: timedelta, the duration of the buckets, aligned to start (or to the epoch if start is None)
+            start, end: datetime, the bounds (included, to the microsecond) of the range, unbounded if None
+        return:
+            HistoryBuckets of NumPy arrays, one entry per bucket holding records of the parameter
+        """
+        ...
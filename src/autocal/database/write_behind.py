@@ -0,0 +1,165 @@
+from datetime import datetime
+import threading
+import time
+
+
+class WriteBehindDatabase:
+    """Write-behind queue in front of a CalibrationStorage.
+    The inserts return immediately with the timestamp of the record, a background thread writes
+    the queued records in one transaction per batch_size records or max_delay seconds.
+    The reads of the last parameters and timestamps take the queued records into account,
+    the other reads are passed to the database after the queue is flushed.
+    """
+
+    def __init__(self, database, batch_size=64, max_delay=0.05) -> None:
+        """
+        args:
+            database: the CalibrationStorage to be written
+            batch_size: maximal number of records written in one transaction
+            max_delay: maximal time in seconds a record waits in the queue
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        # records (table_name, var_dict, calibration_log, timestamp), kept until committed
+        self.queue = list()
+        self.flushing = 0
+        # errors of the records which could not be written since the last flush
+        self.errors = list()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        # the other methods see the database with all queued records written
+        attribute = getattr(self.database, name)
+        if callable(attribute):
+            def flushed(*args, **kwargs):
+                self.flush()
+                return attribute(*args, **kwargs)
+            return flushed
+        return attribute
+
+    def insert(self, table_name, var_dict, calibration_log="", timestamp=None):
+        return self.insert_many([(table_name, var_dict, calibration_log, timestamp)])[0]
+
+    def insert_many(self, records):
+        now = datetime.now()
+        records = [(table_name, dict(var_dict), calibration_log, now if timestamp is None else timestamp)
+                   for table_name, var_dict, calibration_log, timestamp in
+                   (tuple(record) + (None,) * (4 - len(record)) for record in records)]
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("the write-behind queue is closed")
+            self.queue.extend(records)
+            self.condition.notify_all()
+        return [record[3] for record in records]
+
+    def _last_queued(self, table_name):
+        """return the latest queued record of a table, or None (to be called with the condition held)"""
+        latest = None
+        for record in reversed(self.queue):
+            if record[0] == table_name and (latest is None or record[3] > latest[3]):
+                latest = record
+        return latest
+
+    def _last_record(self, table_name):
+        """return the latest queued record of a table if it is newer than the stored ones, or None"""
+        with self.condition:
+            record = self._last_queued(table_name)
+        if record is None:
+            return None
+        # a record queued back in time could be older than the stored last record
+        stored = self.database.last_timestamp(table_name)
+        if stored is not None and stored > record[3]:
+            return None
+        return record
+
+    def last_timestamp(self, table_name):
+        record = self._last_record(table_name)
+        if record is not None:
+            return record[3]
+        return self.database.last_timestamp(table_name)
+
+    def last_params(self, table_name, *args):
+        record = self._last_record(table_name)
+        if record is not None:
+            return [record[1].get(k) for k in args]
+        return self.database.last_params(table_name, *args)
+
+    def last_params_many(self, keys):
+        keys = list(keys)
+        queued = {table_name: self._last_record(table_name)
+                  for table_name, _ in keys}
+        stored = self.database.last_params_many(
+            [key for key in keys if queued[key[0]] is None])
+        stored.reverse()
+        return [stored.pop() if queued[table_name] is None else queued[table_name][1].get(param_key)
+                for table_name, param_key in keys]
+
+    def flush(self):
+        """block until all queued records are committed to the database,
+        raise the error of the writer thread if a record could not be written since the last flush,
+        or an ExceptionGroup of all errors if several records could not be written
+        """
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                while self.queue and not self.errors:
+                    self.condition.wait()
+            finally:
+                self.flushing -= 1
+            errors, self.errors = self.errors, list()
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise ExceptionGroup(f"{len(errors)} records could not be written", errors)
+
+    def close(self):
+        """flush the queue and stop the writer thread"""
+        try:
+            self.flush()
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+            self.thread.join()
+
+    def _next_batch(self):
+        """block until a batch is due, return None if closed with an empty queue"""
+        with self.condition:
+            while not self.queue:
+                if not self.running:
+                    return None
+                self.condition.wait()
+            deadline = time.monotonic() + self.max_delay
+            while len(self.queue) < self.batch_size and self.running and not self.flushing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.queue[:self.batch_size]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            errors = list()
+            try:
+                self.database.insert_many(batch)
+            except Exception:
+                # the failed transaction wrote nothing, the records are written one by one
+                # so that only the invalid ones are dropped
+                for record in batch:
+                    try:
+                        self.database.insert_many([record])
+                    except Exception as e:
+                        errors.append(e)
+            with self.condition:
+                self.errors.extend(errors)
+                # written or failed, the records leave the queue
+                del self.queue[:len(batch)]
+                self.condition.notify_all()
@@ -1,8 +1,14 @@
 import configparser
+import hashlib
+import importlib.util
+import json
+import os
 import re
-from importlib import import_module
+import sys
+import threading
 from pathlib import Path
 from ..core.exceptions import ParsingFailure
+from ..core.graph import DependencyGraph
 from ..core.node import CalibrationNode, BaseNode
 
 
@@ -46,6 +52,67 @@ def retrieve_typed_param(string_like):
             return string_like
 
 
+def parse_section(section_config):
+    """typed values of a section, with the lists parsed"""
+    this_node = dict()
+    for k, v in section_config.items():
+        if k in ("parameters", "dependent parameters", "qubits",):
+            this_node[k] = parse_string_list(v)
+        else:
+            this_node[k] = retrieve_typed_param(v)
+    return this_node
+
+
+# placeholder of the qubit in the template sections, e.g. [Rabi@{qubit}]
+TEMPLATE_PLACEHOLDER = "{qubit}"
+
+
+def substitute_qubit(value, qubit):
+    if isinstance(value, str):
+        return value.replace(TEMPLATE_PLACEHOLDER, qubit)
+    if isinstance(value, list):
+        return [substitute_qubit(v, qubit) for v in value]
+    return value
+
+
+def expand_templates(nodes_config, templates, base_overrides, qubits):
+    """expand the template sections into one node per qubit, named e.g. Rabi@q1
+    args:
+        nodes_config: the nodes configuration, extended in place
+        templates: dictionary of template section name -> parsed section, whose values may hold {qubit},
+            the qubits are given by its "qubits" key, or the qubits of [General] otherwise
+        base_overrides: dictionary of qubit -> parsed [Base@qubit] section, the base parameters
+            param@qubit of this qubit; a referenced param@qubit without override takes the value of param in [Base]
+        qubits: list of qubits of [General]
+    """
+    for template_name, template in templates.items():
+        # the keys depending on the qubit are found once per template, the other values are shared
+        templated = [k for k, v in template.items()
+                     if TEMPLATE_PLACEHOLDER in str(v) and k != "qubits"]
+        for qubit in template.get("qubits", qubits):
+            this_node = {k: v for k, v in template.items() if k != "qubits"}
+            for k in templated:
+                this_node[k] = substitute_qubit(template[k], qubit)
+            name = substitute_qubit(template_name, qubit)
+            if name in nodes_config:
+                raise ParsingFailure(
+                    f"node {name} of template {template_name} is already defined")
+            nodes_config[name] = this_node
+    base = nodes_config["Base"]
+    for qubit, overrides in base_overrides.items():
+        for k, v in overrides.items():
+            base[f"{k}@{qubit}"] = v
+    for name, config in nodes_config.items():
+        for key in config.get("dependent parameters", list()):
+            node_name, param = parse_param(key)
+            if node_name == "Base" and param not in base and "@" in param:
+                default = param.split("@")[0]
+                if default not in base:
+                    raise ParsingFailure(
+                        f"node {name} depends on {param}, which has neither an override nor a default in Base")
+                base[param] = base[default]
+
+
 def config2dict(filelike_configuration):
     """To construct a dictionary describing the nodes from the file
         return:
@@ -65,64 +132,175 @@ def config2dict(filelike_configuration):
                 -- tolerance:
                 -- timeout:
                 -- other_param1:
+    Template sections ([Rabi@{qubit}]) are expanded over the qubits (see expand_templates),
+    with the per-qubit base parameters given in [Base@q1] sections
     """
     config = configparser.ConfigParser(inline_comment_prefixes=(';', '#',))
     config.read(Path(filelike_configuration).resolve())
     base_directory = None
     database_address = None
+    qubits = list()
     nodes_config = dict()
     nodes_config["Base"] = dict()
+    templates = dict()
+    base_overrides = dict()
     for section in config.sections():
         # common configurations
         if section == "General":
             database_address = config[section]["database address"]
             base_directory = config[section]["base directory"]
+            qubits = parse_string_list(config[section].get("qubits", ""))
+        elif TEMPLATE_PLACEHOLDER in section:
+            templates[section] = parse_section(config[section])
+        elif section.startswith("Base@"):
+            base_overrides[section[len("Base@"):]] = parse_section(
+                config[section])
         else:
             # make a new node
-            nodes_config[section] = dict()
-            this_node = nodes_config[section]
-            this_config = config[section]
-            for k, v in this_config.items():
-                if k in ("parameters", "dependent parameters",):
-                    this_node[k] = parse_string_list(v)
-                else:
-                    this_node[k] = retrieve_typed_param(v)
+            nodes_config[section] = parse_section(config[section])
+    expand_templates(nodes_config, templates, base_overrides, qubits)
     return database_address, base_directory, nodes_config
 
 
 def topological_sort(dag_dict):
     """topological sorting of DAG"""
-    temporary_mark = set()
-    permanent_mark = set()
-    sorted = list()
-
-    def visit(node, temporary_mark, permanent_mark):
-        if node in permanent_mark:
-            return
-        if node in temporary_mark:
-            loop = "-".join(temporary_mark)
-            raise ParsingFailure(
-                f"the graph is not acyclic, with a loop {loop}")
-        temporary_mark |= {node}
-        for n in dag_dict[node]:
-            try:
-                visit(n, temporary_mark, permanent_mark)
-            except KeyError:
-                raise ParsingFailure(
-                    f"node {node} has a unresolved parents {n}")
-        temporary_mark.remove(node)
-        permanent_mark |= {node}
-        sorted.append(node)
+    graph = DependencyGraph(dag_dict)
+    return [graph.names[i] for i in graph.topological_order()]
+
+
+# resolved path of a calibration file -> module, so that a file shared by several nodes is imported once
+_module_cache = dict()
+_module_lock = threading.Lock()
+
+
+def calibration_package(directory):
+    """register the package standing for a directory of calibration files, return its name
+    the calibration files are its submodules, so that they can import each other relatively
+    """
+    name = "autocal_calibrations_" + \
+        hashlib.sha1(str(directory).encode()).hexdigest()[:8]
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_loader(name, None, is_package=True)
+        spec.submodule_search_locations = [str(directory)]
+        sys.modules[name] = importlib.util.module_from_spec(spec)
+    return name
 
-    for key in dag_dict.keys():
-        visit(key, temporary_mark, permanent_mark)
 
-    return sorted
+def import_calibration_module(path):
+    """import a calibration file by its path, once per resolved path"""
+    path = Path(path).resolve()
+    with _module_lock:
+        if path not in _module_cache:
+            name = f"{calibration_package(path.parent)}.{path.stem}"
+            # already imported relatively by another calibration file
+            module = sys.modules.get(name)
+            if module is None:
+                spec = importlib.util.spec_from_file_location(name, path)
+                if spec is None:
+                    raise ParsingFailure(f"{path} is not a python file")
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[name] = module
+                try:
+                    spec.loader.exec_module(module)
+                except BaseException:
+                    del sys.modules[name]
+                    raise
+            _module_cache[path] = module
+        return _module_cache[path]
 
 
 def imported_calibration(base_path, filelike):
-    path = Path(base_path) / filelike
-    return import_module(str(path).replace("/", ".").strip(".py")).CustomizedCalibration
+    return import_calibration_module(Path(base_path) / filelike).CustomizedCalibration
+
+
+class LazyCalibration:
+    """Stands for the calibration of a node until it is used: the calibration file is imported,
+    and the CustomizedCalibration instantiated, on the first access beyond the attributes known from the
+    configuration (name, param_keys, dependent_param_keys, timeout), which the node needs when built.
+    Thus the modules (and their heavy dependencies) of the nodes never run in a session are never imported.
+    """
+
+    known_attributes = ("name", "param_keys", "dependent_param_keys", "timeout")
+
+    def __init__(self, base_path, filelike, kwargs) -> None:
+        self.__dict__["_path"] = Path(base_path) / filelike
+        self.__dict__["_kwargs"] = kwargs
+        self.__dict__["_calibration"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def load(self):
+        """import and instantiate the calibration if not done yet, return it"""
+        with self._lock:
+            if self._calibration is None:
+                calibration_class = import_calibration_module(
+                    self._path).CustomizedCalibration
+                self.__dict__["_calibration"] = calibration_class(
+                    **self._kwargs)
+        return self._calibration
+
+    @property
+    def loaded(self):
+        return self._calibration is not None
+
+    def __getattr__(self, name):
+        if self._calibration is None and name in self.known_attributes and name in self._kwargs:
+            return self._kwargs[name]
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+
+# version of the compiled configuration cached by load_config, to be increased with every change
+# of the output of config2dict, expand_templates or resolve_dag, so that the older caches are compiled again
+CONFIG_CACHE_VERSION = 1
+
+
+def config_digest(filelike_configuration, base_directory=None, filenames=()):
+    """hash of the cache version, the configuration file and the calibration files it refers to"""
+    digest = hashlib.sha256(f"{CONFIG_CACHE_VERSION}\0".encode())
+    digest.update(Path(filelike_configuration).read_bytes())
+    for filename in filenames:
+        path = Path(base_directory) / filename
+        digest.update(filename.encode() + b"\0")
+        digest.update(path.read_bytes() if path.exists() else b"\0missing")
+    return digest.hexdigest()
+
+
+def load_config(filelike_configuration, cache_path=None):
+    """config2dict and resolve_dag, with the result cached in a JSON file (by default next to the configuration)
+    which is loaded directly as long as the configuration and the calibration files are unchanged
+    return:
+        database_address, base_directory, nodes_config: see config2dict
+        graph: (dag_dict, sorted), see resolve_dag
+    """
+    cache_path = Path(str(filelike_configuration) + ".cache") if cache_path is None else Path(cache_path)
+    try:
+        cached = json.loads(cache_path.read_text())
+        if cached["digest"] == config_digest(filelike_configuration, cached["base_directory"], cached["filenames"]):
+            return (cached["database_address"], cached["base_directory"], cached["nodes_config"],
+                    (cached["dag_dict"], cached["sorted"]))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # no valid cache, compiled again
+    database_address, base_directory, nodes_config = config2dict(
+        filelike_configuration)
+    dag_dict, sorted = resolve_dag(nodes_config)
+    filenames = list(dict.fromkeys(config["filename"] for name, config in nodes_config.items()
+                                   if "filename" in config))
+    cached = {"digest": config_digest(filelike_configuration, base_directory, filenames),
+              "filenames": filenames,
+              "database_address": database_address,
+              "base_directory": base_directory,
+              "nodes_config": nodes_config,
+              "dag_dict": dag_dict,
+              "sorted": sorted}
+    temporary = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        temporary.write_text(json.dumps(cached))
+        os.replace(temporary, cache_path)
+    except OSError:
+        pass  # e.g. a read-only directory, the configuration is compiled at every start then
+    return database_address, base_directory, nodes_config, (dag_dict, sorted)
 
 
 keyword_mapping = {"parameters": "param_keys",
@@ -130,40 +308,103 @@ keyword_mapping = {"parameters": "param_keys",
                    "bad data threshold": "bad_data_threshold"}
 
 
-def dict2dag(base_directory, database, nodes_config):
-    # resolve a DAG from the dependents
+def resolve_dag(nodes_config):
+    """resolve the DAG from the dependent parameters, and check its validity by sorting it
+    return:
+        dag_dict: dictionary of node name -> sorted list of the names of its dependents
+        sorted: list of the node names in topological order
+    """
     dag_dict = dict()
     dag_dict["Base"] = list()
     for name, config in nodes_config.items():
         if name != "Base":
-            dependents = {parse_param(s)[0]
-                          for s in config["dependent parameters"]}
-            dag_dict[name] = dependents
-    # check the validity of dag during the topological sorting
-    sorted = topological_sort(dag_dict)
+            dag_dict[name] = sorted({parse_param(s)[0]
+                                     for s in config["dependent parameters"]})
+    return dag_dict, topological_sort(dag_dict)
+
+
+def dict2dag(base_directory, database, nodes_config, scan_store=None, lazy=True, graph=None):
+    """build the nodes of a DAG from the configuration
+    args:
+        graph: (dag_dict, sorted) as returned by resolve_dag (e.g. from load_config), resolved if None
+        lazy: if the calibration files are imported on the first use of their nodes (see LazyCalibration),
+            otherwise all are imported while building
+    """
+    if graph is None:
+        graph = resolve_dag(nodes_config)
+    dag_dict, sorted = graph
+    # register all nodes at once, the nodes then find their parameters registered
+    register_nodes(database, nodes_config)
     dag_container = dict()
-    # initialize base node
-    dag_container["Base"] = BaseNode(
-        database, **nodes_config["Base"])
-    # initialize all nodes based on topological sorting
-    sorted.remove("Base")
     for nodename in sorted:
-        # retrieve arguments, instantiate calibration objects
-        this_config = nodes_config[nodename]
-        filelike = this_config["filename"]
-        # build arguments for the calibration
-        kwargs = dict()
-        kwargs["name"] = nodename
-        for key, value in this_config.items():
-            if key == "filename":
-                continue
-            key = keyword_mapping[key] if key in keyword_mapping.keys(
-            ) else key
-            kwargs[key] = value
-        calibration = imported_calibration(base_directory, filelike)(**kwargs)
-        # instantiate calibration nodes objects
         dependents = [dag_container[dep] for dep in dag_dict[nodename]]
-        dag_container[nodename] = CalibrationNode(calibration=calibration,
-                                                  database=database,
-                                                  dependents=dependents)
+        dag_container[nodename] = build_node(nodename, nodes_config[nodename], dependents,
+                                             base_directory, database, scan_store, lazy)
     return dag_container
+
+
+def register_nodes(database, nodes_config):
+    database.initialize_tables({name: list(config.keys()) if name == "Base" else config.get("parameters", [])
+                                for name, config in nodes_config.items()})
+
+
+def build_node(nodename, this_config, dependents, base_directory, database, scan_store=None, lazy=True):
+    """instantiate one node of dict2dag from its configuration"""
+    if nodename == "Base":
+        return BaseNode(database, **this_config)
+    # retrieve arguments, instantiate calibration objects
+    filelike = this_config["filename"]
+    # build arguments for the calibration
+    kwargs = dict()
+    kwargs["name"] = nodename
+    for key, value in this_config.items():
+        if key == "filename":
+            continue
+        key = keyword_mapping[key] if key in keyword_mapping.keys(
+        ) else key
+        kwargs[key] = value
+    calibration = LazyCalibration(base_directory, filelike, kwargs)
+    if not lazy:
+        calibration = calibration.load()
+    # instantiate calibration nodes objects
+    return CalibrationNode(calibration=calibration,
+                           database=database,
+                           dependents=dependents,
+                           scan_store=scan_store)
+
+
+def update_dag(dag_container, old_nodes_config, base_directory, database, nodes_config,
+               scan_store=None, lazy=True, graph=None):
+    """rebuild a DAG after a change of the configuration, section by section:
+    only the nodes whose configuration changed (or which are new) are built again,
+    the other nodes are kept with their calibration objects and flags, and relinked to the rebuilt dependents.
+    The records of all nodes are kept in the database.
+    args:
+        dag_container: the DAG built from old_nodes_config, by dict2dag or update_dag
+        old_nodes_config: the configuration of dag_container
+        others: see dict2dag
+    return:
+        the new dag_container, the objects holding the old one (e.g. a ParallelMaintainer) have to be created again
+    """
+    if graph is None:
+        graph = resolve_dag(nodes_config)
+    dag_dict, sorted = graph
+    changed = {name for name, config in nodes_config.items()
+               if name not in dag_container or old_nodes_config.get(name) != config}
+    register_nodes(database, {name: nodes_config[name] for name in changed})
+    # the nodes rebuilt or removed are detached from their dependents
+    for name, node in dag_container.items():
+        if name in changed or name not in nodes_config:
+            node.relink([])
+    new_container = dict()
+    for nodename in sorted:
+        dependents = [new_container[dep] for dep in dag_dict[nodename]]
+        if nodename in changed:
+            new_container[nodename] = build_node(nodename, nodes_config[nodename], dependents,
+                                                 base_directory, database, scan_store, lazy)
+            continue
+        node = dag_container[nodename]
+        if any(a is not b for a, b in zip(node.dependents, dependents)) or len(node.dependents) != len(dependents):
+            node.relink(dependents)
+        new_container[nodename] = node
+    return new_container
@@ -1,5 +1,305 @@
 import unittest
+import asyncio
+import sys
+import time
+import threading
+from datetime import timedelta
 import numpy as np
+from src.autocal.core.interface import Calibration, AsyncCalibration, CheckDataResult, CalibrationResult
+from src.autocal.core.node import CalibrationNode, BaseNode
+from src.autocal.core.scheduler import ParallelMaintainer, ExpiryScheduler
+from src.autocal.core.container import NodeContainer
+from src.autocal.core.exceptions import CalibrationFailure
+from src.autocal.database import CalibrationDatabase
 
 
-class
+class CountingCalibration(Calibration):
+    """a calibration always in spec, which counts how many times it is calibrated"""
+
+    def __init__(self, name, dependent_param_keys=(), barrier=None, succeed=True, timeout=60) -> None:
+        super().__init__(name, ["value"], list(dependent_param_keys), timeout=timeout)
+        self.barrier = barrier
+        self.succeed = succeed
+        self.calibrated = 0
+        self.checked = 0
+        # the outcome of check_data
+        self.bad_data = False
+        self.in_spec = True
+
+    def check_data(self, param):
+        self.checked += 1
+        return CheckDataResult(bad_data=self.bad_data, in_spec=self.in_spec)
+
+    def calibrate(self):
+        if self.barrier is not None:
+            self.barrier.wait()  # only passes if the sibling branch runs concurrently
+        self.calibrated += 1
+        return CalibrationResult(bad_data=False,
+                                 succeeded=self.succeed,
+                                 error_message="",
+                                 calibrated_params=np.array([1.0]))
+
+
+class AsyncCountingCalibration(AsyncCalibration):
+    """the asynchronous variant of CountingCalibration"""
+
+    def __init__(self, name, dependent_param_keys=(), barrier=None) -> None:
+        super().__init__(name, ["value"], list(dependent_param_keys), timeout=60)
+        self.barrier = barrier
+        self.calibrated = 0
+
+    async def check_data(self, param):
+        return CheckDataResult(bad_data=False, in_spec=True)
+
+    async def calibrate(self):
+        if self.barrier is not None:
+            await asyncio.wait_for(self.barrier.wait(), timeout=5)
+        self.calibrated += 1
+        return CalibrationResult(bad_data=False,
+                                 succeeded=True,
+                                 error_message="",
+                                 calibrated_params=np.array([1.0]))
+
+
+class CountingDatabase(CalibrationDatabase):
+    """counts the timestamp lookups"""
+
+    def __init__(self, database_address) -> None:
+        super().__init__(database_address)
+        self.timestamp_lookups = 0
+
+    def last_timestamp(self, table_name):
+        self.timestamp_lookups += 1
+        return super().last_timestamp(table_name)
+
+
+class DAGTestCase(unittest.TestCase):
+    """ Example DAG, two independent branches sharing the base:
+    Base-A1-A2
+       |-B1-B2
+    """
+
+    def setUp(self) -> None:
+        self.database = CalibrationDatabase(":memory:")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.database.close()
+        return super().tearDown()
+
+    def build_branches(self, barrier=None, succeed=True):
+        base = BaseNode(self.database, param=1.0)
+        dag_container = {"Base": base}
+        for branch in "AB":
+            first = CountingCalibration(
+                f"{branch}1", ["Base - param"], barrier=barrier)
+            second = CountingCalibration(
+                f"{branch}2", [f"{branch}1 - value"], succeed=succeed)
+            dag_container[first.name] = CalibrationNode(
+                first, self.database, [base])
+            dag_container[second.name] = CalibrationNode(
+                second, self.database, [dag_container[first.name]])
+        return dag_container
+
+    def test_maintain(self):
+        dag_container = self.build_branches()
+        dag_container["A2"].maintain()
+        for name in ("A1", "A2"):
+            self.assertEqual(dag_container[name].calibration.calibrated, 1)
+            self.assertFalse(dag_container[name].recalibrated)
+        self.assertEqual(dag_container["B1"].calibration.calibrated, 0)
+        # still valid, nothing to be done
+        dag_container["A2"].maintain()
+        self.assertEqual(dag_container["A2"].calibration.calibrated, 1)
+
+    def test_parallel_maintain(self):
+        dag_container = self.build_branches(
+            barrier=threading.Barrier(2, timeout=5))
+        ParallelMaintainer(dag_container, max_workers=2).maintain()
+        for name in ("A1", "A2", "B1", "B2"):
+            self.assertEqual(dag_container[name].calibration.calibrated, 1)
+            self.assertFalse(dag_container[name].recalibrated)
+        maintainer = ParallelMaintainer(dag_container)
+        self.assertEqual(maintainer.upper_branches(["B2"]), ["Base", "B1", "B2"])
+
+    def test_parallel_maintain_failure(self):
+        dag_container = self.build_branches(succeed=False)
+        with self.assertRaises(CalibrationFailure):
+            ParallelMaintainer(dag_container).maintain("A2")
+        self.assertEqual(dag_container["A1"].calibration.calibrated, 1)
+        self.assertTrue(dag_container["A2"].calibration_failed)
+
+    def test_node_container(self):
+        dag_container = self.build_branches()
+        container = NodeContainer(dag_container)
+        self.assertIs(container.get_node("A1"), dag_container["A1"])
+        with self.assertRaises(KeyError):
+            container.get_node("C1")
+        self.assertEqual({node.name for node in container.get_leaf_nodes()}, {"A2", "B2"})
+        self.assertEqual([node.name for node in container.upper_branch("A2")], ["Base", "A1", "A2"])
+        self.assertEqual({node.name for node in container.invalidated_by("Base")},
+                         {"A1", "A2", "B1", "B2"})
+        self.assertEqual([node.name for node in container.lower_branch("B1")], ["B1", "B2"])
+        self.assertTrue(container.depends_on("A2", "Base"))
+        self.assertFalse(container.depends_on("A2", "B1"))
+        container.maintain("A2")
+        self.assertEqual(dag_container["A1"].calibration.calibrated, 1)
+        self.assertEqual(dag_container["B1"].calibration.calibrated, 0)
+        self.assertFalse(dag_container["A2"].recalibrated)
+        container.maintain()
+        self.assertEqual(dag_container["B2"].calibration.calibrated, 1)
+        self.assertEqual(dag_container["A2"].calibration.calibrated, 1)
+
+    def test_parallel_diagnose_lock_order(self):
+        """ X and Y visit their shared parents in opposite orders while diagnosing bad data:
+        Base-P-X
+           |-Q-Y  (X -> [P, Q], Y -> [Q, P])
+        """
+        base = BaseNode(self.database, param=1.0)
+        dag_container = {"Base": base}
+        for name in "PQ":
+            dag_container[name] = CalibrationNode(
+                CountingCalibration(name, ["Base - param"]), self.database, [base])
+        for name, parents in (("X", "PQ"), ("Y", "QP")):
+            dag_container[name] = CalibrationNode(CountingCalibration(name),
+                                                  self.database, [dag_container[p] for p in parents])
+        ParallelMaintainer(dag_container).maintain()
+        # P and Q are still valid but out of spec, X and Y time out and get bad data
+        barrier = threading.Barrier(2, timeout=5)
+        for name in "PQ":
+            dag_container[name].calibration.in_spec = False
+            dag_container[name].calibration.barrier = barrier
+        for name in "XY":
+            dag_container[name].calibration.bad_data = True
+            dag_container[name].period_of_validity = timedelta(0)
+        errors = list()
+
+        def maintain():
+            try:
+                ParallelMaintainer(dag_container, max_workers=2).maintain()
+            except Exception as e:
+                errors.append(e)
+
+        # X diagnoses P while Y diagnoses Q, then each moves on to the other parent
+        thread = threading.Thread(target=maintain, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive(), "deadlock in the diagnose")
+        self.assertEqual(errors, [])
+        for name in "PQXY":
+            self.assertEqual(dag_container[name].calibration.calibrated, 3 if name in "PQ" else 2)
+
+    def test_state_expires_between_passes(self):
+        dag_container = self.build_branches()
+        node = dag_container["A2"]
+        node.maintain()
+        # a state memorized outside of a pass is not kept by the next pass
+        self.assertTrue(node.check_state())
+        node.period_of_validity = timedelta(0)
+        self.assertTrue(node.timeout)
+        checked = node.calibration.checked
+        node.maintain()
+        self.assertEqual(node.calibration.checked, checked + 1)
+        for maintain in (lambda: ParallelMaintainer(dag_container).maintain("A2"),
+                         lambda: NodeContainer(dag_container).maintain("A2")):
+            node.period_of_validity = timedelta(minutes=60)
+            self.assertTrue(node.check_state())
+            node.period_of_validity = timedelta(0)
+            checked = node.calibration.checked
+            maintain()
+            self.assertEqual(node.calibration.checked, checked + 1)
+
+    def test_state_cache(self):
+        """ a lattice of depth 12, where every node depends on both nodes of the previous layer,
+        thus with 2^12 paths from the top to the base
+        """
+        database = CountingDatabase(":memory:")
+        layer = [BaseNode(database, param=1.0)]
+        for depth in range(12):
+            layer = [CalibrationNode(CountingCalibration(f"L{depth}_{i}"), database, layer)
+                     for i in range(2)]
+        top = CalibrationNode(CountingCalibration("top"), database, layer)
+        top.maintain()
+        self.assertEqual(top.calibration.calibrated, 1)
+        database.timestamp_lookups = 0
+        top.maintain()
+        self.assertLessEqual(database.timestamp_lookups, 25)
+        self.assertIsNone(top.state)
+
+    def test_deep_chain(self):
+        """a chain longer than the recursion limit"""
+        node = BaseNode(self.database, param=1.0)
+        for depth in range(sys.getrecursionlimit() + 100):
+            node = CalibrationNode(CountingCalibration(
+                f"C{depth}"), self.database, [node])
+        node.maintain()
+        self.assertEqual(node.calibration.calibrated, 1)
+        self.assertFalse(node.diagnose())
+
+    def test_expiry_scheduler(self):
+        base = BaseNode(self.database, param=1.0)
+        # valid for 60 ms only
+        node = CalibrationNode(CountingCalibration("short", ["Base - param"], timeout=0.001),
+                               self.database, [base])
+        scheduler = ExpiryScheduler({"Base": base, "short": node},
+                                    margin=timedelta(0))
+        scheduler.start()
+        try:
+            deadline = time.time() + 5
+            while node.calibration.checked < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            scheduler.stop()
+        self.assertEqual(scheduler.failures, [])
+        # calibrated once as never calibrated before, then only refreshed by checking data
+        self.assertEqual(node.calibration.calibrated, 1)
+        self.assertGreaterEqual(node.calibration.checked, 2)
+        self.assertEqual(node.update_callbacks, [])
+
+    def test_expiry_scheduler_margin(self):
+        base = BaseNode(self.database, param=1.0)
+        # valid for 600 ms, less than the default margin of a minute
+        node = CalibrationNode(CountingCalibration("short", ["Base - param"], timeout=0.01),
+                               self.database, [base])
+        scheduler = ExpiryScheduler({"Base": base, "short": node})
+        self.assertEqual(scheduler.node_margin("short"), timedelta(milliseconds=300))
+        scheduler.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            scheduler.stop()
+        # calibrated at the start, then refreshed at most once, 300 ms later
+        self.assertEqual(node.calibration.calibrated, 1)
+        self.assertLessEqual(node.calibration.checked, 1)
+
+    def test_async_defaults(self):
+        calibration = AsyncCalibration("Default", ["value"], [], timeout=60)
+        self.assertEqual(asyncio.run(calibration.check_data([0])),
+                         CheckDataResult(bad_data=False, in_spec=True))
+        result = asyncio.run(calibration.calibrate())
+        self.assertFalse(result.succeeded)
+        np.testing.assert_array_equal(result.calibrated_params, [0])
+        self.assertEqual(calibration.logger.dump(),
+                         "check_data method is not inherited and thus not valid"
+                         "calibrate method is not inherited and thus not valid")
+        self.assertEqual(calibration.logger.dump(), "")
+
+    def test_async_maintain(self):
+        async def maintain():
+            barrier = asyncio.Barrier(2)
+            base = BaseNode(self.database, param=1.0)
+            branches = [CalibrationNode(AsyncCountingCalibration(name, ["Base - param"], barrier=barrier),
+                                        self.database, [base]) for name in ("A", "B")]
+            # a blocking calibration depending on both asynchronous ones
+            top = CalibrationNode(CountingCalibration("C", ["A - value", "B - value"]),
+                                  self.database, branches)
+            await top.maintain_async()
+            return branches + [top]
+
+        for node in asyncio.run(maintain()):
+            self.assertEqual(node.calibration.calibrated, 1)
+            self.assertFalse(node.recalibrated)
+
+
+if __name__ == "__main__":
+    unittest.main()
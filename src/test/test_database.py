@@ -0,0 +1,465 @@
+import unittest
+import tempfile
+import sqlite3
+import zlib
+import numpy as np
+from pathlib import Path
+from datetime import datetime, timedelta
+from src.autocal.database import CalibrationDatabase, LatestRecordCache, WriteBehindDatabase, \
+    CalibrationStorage, InMemoryDatabase, ColumnarDatabase, ScanStore, read_snapshot, write_snapshot, \
+    Compactor, validate_name
+from src.autocal.core.scheduler import ParallelMaintainer
+from src.autocal.core.container import NodeContainer
+from src.autocal.database.database import to_ns, from_ns, STATE_MARKER
+from src.autocal.core.node import CalibrationNode, BaseNode
+from src.autocal.core.exceptions import CalibrationFailure
+from src.test.example_calibration import CustomizedCalibration
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_address = Path(self.directory.name) / "test.db"
+        self.database = CalibrationDatabase(self.database_address)
+        self.db_con = self.database.db_con
+        self.database.initialize_table("Rabi", ["pi_amp", "offset"])
+        self.database.initialize_table("T1", ["decay"])
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.database.close()
+        self.directory.cleanup()
+        return super().tearDown()
+
+    def test_insert(self):
+        self.assertIsNone(self.database.last_timestamp("Rabi"))
+        timestamp = self.database.insert(
+            "Rabi", {"pi_amp": 0.5, "offset": 0.1}, "first")
+        self.assertEqual(self.database.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(self.database.last_params(
+            "Rabi", "offset", "pi_amp"), [0.1, 0.5])
+        self.assertEqual(self.database.calibration_log(
+            "Rabi", timestamp), "first")
+        # the log is kept out of the records table, compressed
+        self.assertEqual(self.db_con.execute("SELECT log FROM logs").fetchall(),
+                         [(zlib.compress(b"first"),)])
+        self.assertEqual(self.database.calibration_log("Rabi", self.database.insert(
+            "Rabi", {"pi_amp": 0.5})), "")
+        with self.assertRaises(KeyError):
+            self.database.calibration_log("T1", timestamp)
+
+    def test_insert_many(self):
+        timestamps = self.database.insert_many([("Rabi", {"pi_amp": 0.5, "offset": 0.1}, ""),
+                                                ("T1", {"decay": 2e-5}, "")])
+        self.assertEqual(len(timestamps), 2)
+        self.assertEqual(self.database.last_params("T1", "decay"), [2e-5])
+        # a failing record rolls back the whole batch
+        with self.assertRaises(KeyError):
+            self.database.insert_many([("T1", {"decay": 3e-5}, ""),
+                                       ("T1", {"unknown": 1}, "")])
+        self.assertEqual(self.database.last_params("T1", "decay"), [2e-5])
+
+    def test_initialize_tables(self):
+        tables = {f"N{i}": ["amp", "freq"] for i in range(500)}
+        statements = list()
+        self.db_con.set_trace_callback(statements.append)
+        self.database.initialize_tables(tables)
+        # one transaction, without any schema change
+        self.assertEqual([s for s in statements if s in ("BEGIN ", "COMMIT")],
+                         ["BEGIN ", "COMMIT"])
+        self.assertFalse(any(s.startswith(("CREATE", "ALTER"))
+                         for s in statements))
+        statements.clear()
+        self.database.initialize_tables(tables)
+        self.database.initialize_table("Rabi", ["pi_amp"])
+        self.assertEqual(statements, [])
+        # a restart adds only the new parameters, and keeps the ids
+        self.database.initialize_table("Rabi", ["pi_amp", "detuning"])
+        self.db_con.set_trace_callback(None)
+        self.assertEqual(len(self.database.param_ids["Rabi"]), 3)
+        param_ids = self.database.param_ids
+        self.database.close()
+        self.database = CalibrationDatabase(self.database_address)
+        self.assertEqual(self.database.param_ids, param_ids)
+
+    def test_names(self):
+        for name in ("Rabi", "pi_amp", "Rabi@q1", "qubit freq", "_x.2"):
+            validate_name(name)
+        for name in ("Rabi - amp", "../Rabi", "Rabi; DROP TABLE records", "", "1st", "amp "):
+            with self.subTest(name=name):
+                with self.assertRaises(ValueError):
+                    self.database.initialize_table("Rabi", [name])
+                with self.assertRaises(ValueError):
+                    InMemoryDatabase().initialize_table(name, [])
+        self.assertNotIn("Rabi - amp", self.database.param_ids["Rabi"])
+
+    def test_last_params(self):
+        self.assertEqual(self.database.last_params(
+            "Rabi", "pi_amp", "offset"), [None, None])
+        self.assertIsNone(self.database.last_record("Rabi"))
+        self.database.insert("Rabi", {"pi_amp": 0.5, "offset": 0.1})
+        self.database.insert("Rabi", {"pi_amp": 0.6, "offset": 0.2})
+        self.database.insert("T1", {"decay": 2e-5})
+        self.assertEqual(self.database.last_record("Rabi"),
+                         {"pi_amp": 0.6, "offset": 0.2})
+        self.assertEqual(self.database.last_params_many([("Rabi", "offset"), ("T1", "decay"), ("Rabi", "pi_amp")]),
+                         [0.2, 2e-5, 0.6])
+        self.assertEqual(self.database.last_params_many([]), [])
+
+    def test_latest_record_cache(self):
+        cache = LatestRecordCache(self.database)
+        statements = list()
+        self.db_con.set_trace_callback(statements.append)
+        self.assertIsNone(cache.last_timestamp("Rabi"))
+        cache.insert("Rabi", {"pi_amp": 0.5, "offset": 0.1})
+        timestamp = cache.insert("Rabi", {"pi_amp": 0.6})
+        self.assertEqual(cache.last_params("Rabi", "pi_amp"), [0.6])
+        statements.clear()
+        # served from memory
+        self.assertEqual(cache.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(cache.last_params("Rabi", "pi_amp", "offset"), [0.6, None])
+        self.assertEqual(cache.last_params_many([("Rabi", "pi_amp")]), [0.6])
+        self.assertEqual(statements, [])
+        # written by another connection
+        self.assertFalse(cache.detect_external_writes())
+        self.database.insert("Rabi", {"pi_amp": 0.7})
+        cache.invalidate("Rabi")
+        self.assertEqual(cache.last_params("Rabi", "pi_amp"), [0.7])
+        # a record inserted back in time is stored, but is not the last one
+        cache.insert("Rabi", {"pi_amp": 0.1}, timestamp=timestamp - timedelta(hours=1))
+        self.assertEqual(cache.last_params("Rabi", "pi_amp"), [0.7])
+        self.assertEqual(cache.history("Rabi", "pi_amp")[0], (timestamp - timedelta(hours=1), 0.1))
+
+    def test_base_parameters(self):
+        def count():
+            return self.db_con.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        BaseNode(self.database, param=1, label="q1")
+        self.assertEqual(count(), 1)
+        # the parameters removed from the configuration are not compared
+        BaseNode(self.database, param=1)
+        BaseNode(self.database, param=1)
+        self.assertEqual(count(), 1)
+        BaseNode(self.database, param=2)
+        self.assertEqual(count(), 2)
+
+    def test_stacked_wrappers(self):
+        write_behind = WriteBehindDatabase(LatestRecordCache(self.database))
+        timestamp = write_behind.insert("Rabi", {"pi_amp": 0.5})
+        write_behind.insert_many([("T1", {"decay": 1e-5}, "")])
+        write_behind.flush()
+        self.assertEqual(self.db_con.execute("SELECT COUNT(*) FROM records").fetchone(), (2,))
+        self.assertEqual(write_behind.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(write_behind.last_params("T1", "decay"), [1e-5])
+        # the timestamps given by the caller are kept, a record back in time is not the last one
+        earlier = timestamp - timedelta(hours=1)
+        self.assertEqual(write_behind.insert("Rabi", {"pi_amp": 0.1}, timestamp=earlier), earlier)
+        self.assertEqual(write_behind.insert_many([("Rabi", {"pi_amp": 0.2}, "", earlier)]), [earlier])
+        self.assertEqual(write_behind.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(write_behind.last_params_many([("Rabi", "pi_amp")]), [0.5])
+        self.assertEqual(write_behind.history("Rabi", "pi_amp"),
+                         [(earlier, 0.1), (earlier, 0.2), (timestamp, 0.5)])
+        write_behind.close()
+
+    def test_history(self):
+        timestamps = [self.database.insert("T1", {"decay": i})
+                      for i in range(5)]
+        history = self.database.history(
+            "T1", "decay", start=timestamps[1], end=timestamps[3])
+        self.assertEqual(history, [(timestamps[i], float(i))
+                         for i in range(1, 4)])
+        self.assertEqual(len(self.database.history("T1", "decay")), 5)
+
+    def test_resume(self):
+        self.database.insert("Rabi", {"pi_amp": 0.5, "offset": 0.1})
+        # a restart, with a new parameter
+        database = CalibrationDatabase(self.database_address)
+        database.initialize_table("Rabi", ["pi_amp", "offset", "phase"])
+        self.assertEqual(database.last_record("Rabi"),
+                         {"pi_amp": 0.5, "offset": 0.1, "phase": None})
+        database.insert("Rabi", {"pi_amp": 0.6, "offset": 0.1, "phase": 1})
+        self.assertEqual([row[1] for row in database.history("Rabi", "pi_amp")],
+                         [0.5, 0.6])
+        self.assertEqual(self.db_con.execute(
+            "SELECT COUNT(DISTINCT run_id) FROM records").fetchone()[0], 2)
+        database.close()
+
+    def test_migrate_legacy_tables(self):
+        self.db_con.execute(
+            "CREATE TABLE Old_2021_11_02_13_45_01 (timestamp TEXT PRIMARY KEY, calibration_log TEXT)")
+        self.db_con.execute(
+            "ALTER TABLE Old_2021_11_02_13_45_01 ADD value REAL")
+        old_timestamp = datetime(2021, 11, 2, 13, 45, 1, 123456)
+        for i in range(3):
+            self.db_con.execute("INSERT INTO Old_2021_11_02_13_45_01 VALUES (?, ?, ?)",
+                                ((old_timestamp + timedelta(minutes=i)).strftime('%Y-%m-%d-%H:%M:%S:%f'), "log", i))
+        self.assertEqual(self.database.migrate_legacy_tables(),
+                         ["Old_2021_11_02_13_45_01"])
+        self.assertEqual(self.database.migrate_legacy_tables(), [])
+        self.assertEqual(self.database.last_timestamp("Old"),
+                         old_timestamp + timedelta(minutes=2))
+        self.assertEqual(self.database.last_params("Old", "value"), [2])
+        self.assertEqual(self.database.calibration_log("Old", old_timestamp), "log")
+
+    def test_write_behind(self):
+        database = CalibrationDatabase(":memory:")
+        database.initialize_table("Rabi", ["pi_amp", "offset"])
+        database.initialize_table("T1", ["decay"])
+        database.insert("T1", {"decay": 1e-5})
+        # records stay in the queue until flushed
+        write_behind = WriteBehindDatabase(
+            database, batch_size=100, max_delay=60)
+        timestamp = write_behind.insert("Rabi", {"pi_amp": 0.5})
+        self.assertIsNone(database.last_timestamp("Rabi"))
+        self.assertEqual(write_behind.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(write_behind.last_params(
+            "Rabi", "pi_amp", "offset"), [0.5, None])
+        self.assertEqual(write_behind.last_params_many([("T1", "decay"), ("Rabi", "pi_amp")]),
+                         [1e-5, 0.5])
+        # delegated reads are flushed first
+        self.assertEqual(write_behind.last_record("Rabi"),
+                         {"pi_amp": 0.5, "offset": None})
+        self.assertEqual(database.last_timestamp("Rabi"), timestamp)
+        write_behind.insert("Rabi", {"unknown": 0})
+        with self.assertRaises(KeyError):
+            write_behind.flush()
+        # only the invalid records of a failed batch are dropped
+        timestamp = write_behind.insert("Rabi", {"pi_amp": 0.7})
+        write_behind.insert("T1", {"unknown": 0})
+        write_behind.insert("T1", {"other": 0})
+        with self.assertRaises(ExceptionGroup) as context:
+            write_behind.flush()
+        self.assertEqual(len(context.exception.exceptions), 2)
+        self.assertEqual(database.last_timestamp("Rabi"), timestamp)
+        self.assertEqual(database.last_params("Rabi", "pi_amp"), [0.7])
+        self.assertEqual(database.last_params("T1", "decay"), [1e-5])
+        write_behind.close()
+        database.close()
+
+    def test_reader(self):
+        self.database.insert("T1", {"decay": 1e-5})
+        with self.database.reader() as con:
+            # a history query in progress does not block the writer
+            cursor = con.execute("SELECT timestamp FROM records")
+            cursor.fetchone()
+            self.database.insert("T1", {"decay": 2e-5})
+            with self.assertRaises(sqlite3.OperationalError):
+                con.execute("DELETE FROM records")
+        self.assertEqual([row[1] for row in self.database.history("T1", "decay")],
+                         [1e-5, 2e-5])
+        self.assertEqual(self.db_con.execute(
+            "PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_storage_backends(self):
+        backends = {"sqlite": self.database,
+                    "memory": InMemoryDatabase(),
+                    "columnar": ColumnarDatabase(Path(self.directory.name) / "columnar")}
+        start = datetime.now()
+        for name, database in backends.items():
+            with self.subTest(backend=name):
+                self.assertIsInstance(database, CalibrationStorage)
+                database.initialize_table("Rabi", ["pi_amp", "offset"])
+                database.initialize_table("T1", ["decay"])
+                self.assertIsNone(database.last_record("Rabi"))
+                self.assertEqual(database.last_params("Rabi", "pi_amp"), [None])
+                database.insert("Rabi", {"pi_amp": 0.5}, "log", timestamp=start)
+                database.insert_many([("Rabi", {"pi_amp": 0.4, "offset": 0.1}, "", start + timedelta(seconds=1)),
+                                      ("T1", {"decay": 2e-5}, "", start + timedelta(seconds=2))])
+                self.assertEqual(database.last_timestamp("Rabi"),
+                                 start + timedelta(seconds=1))
+                self.assertEqual(database.last_record("Rabi"),
+                                 {"pi_amp": 0.4, "offset": 0.1})
+                self.assertEqual(database.last_params_many([("T1", "decay"), ("Rabi", "offset")]),
+                                 [2e-5, 0.1])
+                self.assertEqual(database.last_params("Rabi"), [])
+                with self.assertRaises(KeyError):
+                    database.last_params("Unknown")
+                self.assertEqual(database.history("Rabi", "pi_amp", "offset", end=start),
+                                 [(start, 0.5, None)])
+                self.assertEqual(database.calibration_log("Rabi", start), "log")
+                with self.assertRaises(KeyError):
+                    database.insert_many([("T1", {"decay": 1e-5}, "", start + timedelta(seconds=3)),
+                                          ("T1", {"unknown": 0}, "", start + timedelta(seconds=3))])
+                self.assertEqual(database.last_params("T1", "decay"), [2e-5])
+                buckets = database.history_buckets("Rabi", "pi_amp", timedelta(seconds=10),
+                                                   start=start - timedelta(seconds=5))
+                np.testing.assert_array_equal(buckets.count, [2])
+                np.testing.assert_array_equal(buckets.min, [0.4])
+                np.testing.assert_array_equal(buckets.last, [0.4])
+        # the columnar files are read again by a new instance
+        reopened = ColumnarDatabase(Path(self.directory.name) / "columnar")
+        self.assertEqual(reopened.last_record("Rabi"),
+                         {"pi_amp": 0.4, "offset": 0.1})
+        reopened.insert("Rabi", {"pi_amp": "n/a"},
+                        timestamp=start + timedelta(seconds=3))
+        self.assertEqual([row[1] for row in reopened.history("Rabi", "pi_amp")],
+                         [0.5, 0.4, "n/a"])
+        with self.assertRaises(ValueError):
+            reopened.insert("Rabi", {"pi_amp": 0.3}, timestamp=start)
+        # also out of order within a batch, which appends nothing
+        with self.assertRaises(ValueError):
+            reopened.insert_many([("Rabi", {"pi_amp": 0.3}, "", start + timedelta(seconds=5)),
+                                  ("Rabi", {"pi_amp": 0.2}, "", start + timedelta(seconds=4))])
+        self.assertEqual(reopened.last_timestamp("Rabi"), start + timedelta(seconds=3))
+        self.assertFalse(LatestRecordCache(
+            backends["memory"]).detect_external_writes())
+
+    def test_history_buckets(self):
+        start = datetime(2024, 1, 1)
+        values = [0.5, 0.7, 0.6, None, 0.2]
+        self.database.insert_many([("Rabi", {"pi_amp": v, "offset": 0.0} if v is not None else {"offset": 0.0},
+                                    "", start + timedelta(minutes=20 * i)) for i, v in enumerate(values)])
+        buckets = self.database.history_buckets(
+            "Rabi", "pi_amp", timedelta(hours=1), start=start)
+        np.testing.assert_array_equal(buckets.start, [to_ns(start), to_ns(start + timedelta(hours=1))])
+        np.testing.assert_array_equal(buckets.count, [3, 1])
+        np.testing.assert_array_equal(buckets.min, [0.5, 0.2])
+        np.testing.assert_array_equal(buckets.max, [0.7, 0.2])
+        np.testing.assert_allclose(buckets.mean, [0.6, 0.2])
+        np.testing.assert_array_equal(buckets.last, [0.6, 0.2])
+        # the same aggregation on arrays
+        memory = InMemoryDatabase()
+        memory.initialize_table("Rabi", ["pi_amp", "offset"])
+        for timestamp, pi_amp, offset in self.database.history("Rabi", "pi_amp", "offset"):
+            memory.insert("Rabi", {"pi_amp": pi_amp, "offset": offset}, timestamp=timestamp)
+        for field, expected in zip(buckets._fields, buckets):
+            np.testing.assert_allclose(getattr(memory.history_buckets(
+                "Rabi", "pi_amp", timedelta(hours=1), start=start), field), expected)
+        self.assertEqual(len(self.database.history_buckets(
+            "Rabi", "pi_amp", timedelta(hours=1), end=start - timedelta(1)).count), 0)
+        with self.assertRaises(ValueError):
+            self.database.history_buckets("Rabi", "pi_amp", timedelta(0))
+
+    def test_compaction(self):
+        now = datetime.now()
+        day = 24 * 3600 * 10**9
+        # an hour after the start of a day (in UTC, as the buckets), two months ago
+        old = from_ns(to_ns(now - timedelta(days=60)) // day * day + day // 24)
+        records = list()
+        # hourly calibrations with 9 refreshes each, two months ago
+        for hour in range(4):
+            for i in range(10):
+                records.append(("T1", {"decay": float(hour)}, "fitted" if i == 0 else "",
+                                old + timedelta(hours=hour, minutes=5 * i)))
+        # a refresh identical to a calibration with a log is not a refresh
+        records.append(("T1", {"decay": 3.0}, "fitted again", now - timedelta(minutes=2)))
+        records.append(("T1", {"decay": 3.0}, "", now - timedelta(minutes=1)))
+        self.database.insert_many(records)
+        last_timestamp = self.database.last_timestamp("T1")
+        compactor = Compactor(self.database, batch_size=7)
+        self.assertEqual(compactor.compact(), 4 * 9 + 1)
+        self.assertEqual(compactor.compact(), 0)
+        history = self.database.history("T1", "decay")
+        self.assertEqual([row[1] for row in history], [0.0, 1.0, 2.0, 3.0, 3.0])
+        # the kept records are still found by the timestamps returned by insert
+        self.assertEqual(history[0][0], old)
+        self.assertEqual(self.database.last_timestamp("T1"), last_timestamp)
+        self.assertEqual(self.database.calibration_log("T1", old), "fitted")
+        self.assertEqual(self.db_con.execute("SELECT last_refreshed FROM records ORDER BY timestamp LIMIT 1").fetchone(),
+                         (to_ns(old + timedelta(minutes=45)),))
+        # the records of two months ago are downsampled to one per day
+        compactor = Compactor(self.database, downsample_age=timedelta(days=30),
+                              downsample_interval=timedelta(days=1), batch_size=2)
+        self.assertEqual(compactor.compact(), 3)
+        self.assertEqual([row[1] for row in self.database.history("T1", "decay")],
+                         [3.0, 3.0])
+
+    def test_scan_store(self):
+        start = datetime.now()
+        x_data = np.linspace(0, 1, 11)
+        y_data = np.exp(2j * np.pi * x_data)
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                store = ScanStore(Path(self.directory.name) / f"scans_{compress}",
+                                  compress=compress)
+                self.assertEqual(store.timestamps("Rabi"), [])
+                store.save("Rabi", start, x_data, y_data)
+                store.save("Rabi", start + timedelta(seconds=1),
+                           x_data, 2 * y_data)
+                self.assertEqual(store.timestamps("Rabi", end=start), [start])
+                x, y = store.load("Rabi", start + timedelta(seconds=1))
+                # the uncompressed scans are memory mapped
+                self.assertEqual(isinstance(y, np.memmap), not compress)
+                np.testing.assert_array_equal(x, x_data)
+                np.testing.assert_array_equal(y, 2 * y_data)
+                self.assertEqual([t for t, _, _ in store.scans("Rabi", start=start + timedelta(seconds=1))],
+                                 [start + timedelta(seconds=1)])
+                with self.assertRaises(KeyError):
+                    store.load("T1", start)
+        # the nodes keep the data of their fits along with the records
+        store = ScanStore(Path(self.directory.name) / "scans")
+        database = InMemoryDatabase()
+        calibration = CustomizedCalibration(name="Linear", param_keys=["a", "b", "ab"],
+                                            dependent_param_keys=[], timeout=60, tolerance=100,
+                                            bad_data_threshold=1, downsampling=1, otherkeyword1=None)
+        node = CalibrationNode(calibration, database,
+                               [BaseNode(database, param=1.0)], scan_store=store)
+        node.maintain()
+        timestamp = database.last_timestamp("Linear")
+        self.assertEqual(store.timestamps("Linear"), [timestamp])
+        x, _ = store.load("Linear", timestamp)
+        np.testing.assert_array_equal(x, CustomizedCalibration.sweep_space)
+        self.assertIsNone(calibration.last_scan)
+
+    def build_linear(self, database):
+        calibration = CustomizedCalibration(name="Linear", param_keys=["a", "b", "ab"],
+                                            dependent_param_keys=[], timeout=60, tolerance=100,
+                                            bad_data_threshold=1, downsampling=1, otherkeyword1=None)
+        base = BaseNode(database, param=1, label="q1")
+        return {"Base": base, "Linear": CalibrationNode(calibration, database, [base])}
+
+    def test_snapshot(self):
+        snapshot_path = Path(self.directory.name) / "state.snap"
+        self.assertFalse(LatestRecordCache(
+            self.database).restore(snapshot_path))
+        dag_container = self.build_linear(LatestRecordCache(self.database))
+        ParallelMaintainer(dag_container, snapshot_path=snapshot_path).maintain()
+        records = read_snapshot(snapshot_path).records
+        self.assertEqual(records["Base"][2], {"param": 1, "label": "q1"})
+        timestamp, expiry, params = records["Linear"]
+        self.assertEqual(timestamp, self.database.last_timestamp("Linear"))
+        self.assertEqual(expiry, timestamp + timedelta(minutes=60))
+        self.assertEqual(params, self.database.last_record("Linear"))
+        # a restart reads no record from the database
+        self.database.close()
+        self.database = CalibrationDatabase(self.database_address)
+        statements = list()
+        self.database.db_con.set_trace_callback(statements.append)
+        cache = LatestRecordCache(self.database)
+        self.assertTrue(cache.restore(snapshot_path))
+        dag_container = self.build_linear(cache)
+        self.assertTrue(dag_container["Linear"].check_state())
+        self.assertEqual([s for s in statements if "records" in s], [STATE_MARKER])
+        # a record written without updating the snapshot outdates it
+        self.database.insert("Linear", {"a": 2.0})
+        self.assertFalse(LatestRecordCache(
+            self.database).restore(snapshot_path))
+        # and a failed pass does not update it
+        dag_container = self.build_linear(LatestRecordCache(self.database))
+        dag_container["Linear"].period_of_validity = timedelta(0)
+
+        def check_data(param):
+            raise CalibrationFailure("no signal")
+        dag_container["Linear"].calibration.check_data = check_data
+        with self.assertRaises(CalibrationFailure):
+            ParallelMaintainer(dag_container, snapshot_path=snapshot_path).maintain()
+        self.assertEqual(read_snapshot(snapshot_path).records["Linear"], (timestamp, expiry, params))
+        # the serial passes save the snapshot too
+        dag_container = self.build_linear(LatestRecordCache(self.database))
+        for value, maintain in ((3.0, lambda: dag_container["Linear"].maintain(snapshot_path=snapshot_path)),
+                                (4.0, lambda: NodeContainer(dag_container, snapshot_path=snapshot_path).maintain())):
+            dag_container["Linear"].database.insert("Linear", {"a": value})
+            maintain()
+            cache = LatestRecordCache(self.database)
+            self.assertTrue(cache.restore(snapshot_path))
+            self.assertEqual(cache.last_params("Linear", "a"), [value])
+        write_snapshot(snapshot_path, {"Linear": (timestamp, expiry, params),
+                                       "Rabi": (None, None, None)})
+        self.assertEqual(read_snapshot(snapshot_path).records["Rabi"], (None, None, None))
+        # a truncated snapshot is ignored
+        snapshot_path.write_bytes(snapshot_path.read_bytes()[:-3])
+        self.assertFalse(LatestRecordCache(
+            self.database).restore(snapshot_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,14 @@
 import unittest
+import json
+import shutil
+import sys
+from unittest.mock import patch
+import tempfile
 from src.autocal.parsing.dag_parser import *
+from src.autocal.parsing.dag_parser import _module_cache
 from src.autocal.core.exceptions import ParsingFailure
-from src.autocal.database import CalibrationDatabase
+from src.autocal.database import CalibrationDatabase, InMemoryDatabase
 from pathlib import Path
-import sqlite3 as sq
 
 
 class ParserTestCase(unittest.TestCase):
@@ -71,14 +76,161 @@ class ParserTestCase(unittest.TestCase):
         with self.assertRaises(ParsingFailure) as ecm:
             topological_sort(graph_with_loop)
         self.assertIn("acyclic", str(ecm.exception))
+        self.assertIn("a-b-d-e-g-a", str(ecm.exception))
 
     def test_dict2dag(self):
         database_address, base_directory, nodes_config = config2dict(
             self.config_path)
-        with sq.connect(database_address) as db_con:
-            calibration_database = CalibrationDatabase(db_con)
-            dag_container = dict2dag(
-                base_directory, calibration_database, nodes_config)
+        calibration_database = CalibrationDatabase(database_address)
+        dag_container = dict2dag(
+            base_directory, calibration_database, nodes_config)
+        calibration_database.close()
+
+    def test_load_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = Path(directory) / "config.ini"
+            shutil.copy(self.config_path, config_path)
+            compiled = load_config(config_path)
+            self.assertEqual(compiled[:3], config2dict(config_path))
+            self.assertEqual(compiled[3][1], ["Base", "Test"])
+            cache_path = Path(directory) / "config.ini.cache"
+            self.assertTrue(cache_path.exists())
+            # loaded from the cache while the files are unchanged
+            cached = json.loads(cache_path.read_text())
+            cached["nodes_config"]["Test"]["someparam"] = 2
+            cache_path.write_text(json.dumps(cached))
+            self.assertEqual(load_config(config_path)[2]["Test"]["someparam"], 2)
+            # compiled again by another version of the parser
+            with patch("src.autocal.parsing.dag_parser.CONFIG_CACHE_VERSION", CONFIG_CACHE_VERSION + 1):
+                self.assertEqual(load_config(config_path)[2]["Test"]["someparam"], 1)
+            load_config(config_path)
+            cached = json.loads(cache_path.read_text())
+            cached["nodes_config"]["Test"]["someparam"] = 2
+            cache_path.write_text(json.dumps(cached))
+            with open(config_path, "a") as f:
+                f.write("\n; changed\n")
+            self.assertEqual(load_config(config_path)[2]["Test"]["someparam"], 1)
+            database = InMemoryDatabase()
+            dag_container = dict2dag(compiled[1], database, compiled[2],
+                                     graph=compiled[3])
+            self.assertEqual(list(dag_container), ["Base", "Test"])
+
+    def test_templates(self):
+        calibration = """
+filename = example_calibration.py
+parameters = a, b, a_times_b
+tolerance = 0.1
+timeout = 60
+bad data threshold = 5
+downsampling = 5
+"""
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = Path(directory) / "config.ini"
+            config_path.write_text(f"""
+[General]
+base directory = src/test
+database address = :memory:
+qubits = q1, q2
+
+[Base]
+freq = 5e9
+flux = 0.0
+
+[Base@q2]
+freq = 5.2e9
+
+[Test@{{qubit}}]
+{calibration}
+dependent parameters = Base - freq@{{qubit}}
+otherkeyword1 = {{qubit}}
+
+[Chain@{{qubit}}]
+{calibration}
+qubits = q2
+dependent parameters = Test@{{qubit}} - a, Base - flux
+otherkeyword1 = True
+""")
+            _, base_directory, nodes_config = config2dict(config_path)
+        self.assertEqual(list(nodes_config), ["Base", "Test@q1", "Test@q2", "Chain@q2"])
+        self.assertEqual(nodes_config["Base"], {"freq": 5e9, "flux": 0.0,
+                                                "freq@q2": 5.2e9, "freq@q1": 5e9})
+        self.assertEqual(nodes_config["Test@q1"]["dependent parameters"], ["Base - freq@q1"])
+        self.assertEqual(nodes_config["Test@q2"]["otherkeyword1"], "q2")
+        # the values without the placeholder are shared by the instances
+        self.assertIs(nodes_config["Test@q1"]["parameters"],
+                      nodes_config["Test@q2"]["parameters"])
+        dag_container = dict2dag(base_directory, InMemoryDatabase(), nodes_config)
+        self.assertEqual([n.name for n in dag_container["Chain@q2"].dependents], ["Base", "Test@q2"])
+        dag_container["Test@q2"].retrieve_dependent_params()
+        self.assertEqual(list(dag_container["Test@q2"].calibration.dependent_params), [5.2e9])
+
+    def test_update_dag(self):
+        _, base_directory, nodes_config = config2dict(self.config_path)
+        nodes_config["Chained"] = dict(nodes_config["Test"])
+        nodes_config["Chained"]["dependent parameters"] = ["Test - a"]
+        database = InMemoryDatabase()
+        dag_container = dict2dag(base_directory, database, nodes_config)
+        # a tolerance tweak of Test rebuilds Test only
+        new_config = {name: dict(config) for name, config in nodes_config.items()}
+        new_config["Test"]["tolerance"] = 0.2
+        new_container = update_dag(dag_container, nodes_config, base_directory, database, new_config)
+        self.assertIs(new_container["Base"], dag_container["Base"])
+        self.assertIs(new_container["Chained"], dag_container["Chained"])
+        self.assertIsNot(new_container["Test"], dag_container["Test"])
+        self.assertEqual(new_container["Test"].calibration.tolerance, 0.2)
+        self.assertEqual(new_container["Chained"].dependents, [new_container["Test"]])
+        self.assertEqual(new_container["Test"].children, [new_container["Chained"]])
+        self.assertEqual(new_container["Base"].children, [new_container["Test"]])
+        # a removed node is detached
+        old_config = dict(new_config)
+        del new_config["Chained"]
+        newer_container = update_dag(new_container, old_config,
+                                     base_directory, database, new_config)
+        self.assertEqual(list(newer_container), ["Base", "Test"])
+        self.assertIs(newer_container["Test"], new_container["Test"])
+        self.assertEqual(newer_container["Test"].children, [])
+
+    def test_lazy_calibration(self):
+        _, base_directory, nodes_config = config2dict(self.config_path)
+        # a second node from the same file
+        nodes_config["Test2"] = dict(nodes_config["Test"])
+        _module_cache.clear()
+        database = InMemoryDatabase()
+        dag_container = dict2dag(base_directory, database, nodes_config)
+        calibration = dag_container["Test"].calibration
+        self.assertIsInstance(calibration, LazyCalibration)
+        self.assertFalse(calibration.loaded)
+        self.assertEqual(calibration.param_keys, ["a", "b", "a_times_b"])
+        self.assertEqual(_module_cache, {})
+        dag_container["Test"].retrieve_dependent_params()
+        self.assertTrue(calibration.loaded)
+        self.assertEqual(list(calibration.dependent_params),
+                         [3.14e9, "some string"])
+        self.assertEqual(calibration.someparam, 1)
+        self.assertFalse(dag_container["Test2"].calibration.loaded)
+        dag_container["Test2"].calibration.load()
+        self.assertEqual(len(_module_cache), 1)
+        self.assertIs(type(calibration.load()),
+                      type(dag_container["Test2"].calibration.load()))
+        # imported while building if not lazy
+        dag_container = dict2dag(base_directory, database, nodes_config, lazy=False)
+        self.assertNotIsInstance(dag_container["Test"].calibration, LazyCalibration)
+
+    def test_relative_import(self):
+        directory = Path(tempfile.mkdtemp())
+        try:
+            (directory / "helpers.py").write_text("SCALE = 2\n")
+            (directory / "relative_calibration.py").write_text(
+                "from .helpers import SCALE\n\n\n"
+                "class CustomizedCalibration:\n"
+                "    scale = SCALE\n")
+            calibration_class = imported_calibration(directory, "relative_calibration.py")
+            self.assertEqual(calibration_class.scale, 2)
+            # the helper is shared with the calibration files importing it directly
+            helpers = import_calibration_module(directory / "helpers.py")
+            self.assertIs(helpers, sys.modules[calibration_class.__module__.rsplit(".", 1)[0] + ".helpers"])
+        finally:
+            shutil.rmtree(directory)
 
 
 if __name__ == "__main__":